@@ -0,0 +1,237 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+from mutagen.id3 import ID3, TIT1
+from mutagen.flac import FLAC
+from mutagen.mp4 import MP4
+import tagger
+from metrics import Metrics, stage
+
+# Offline benchmark of every stage of the tagger (duration probe, chunk decode,
+# embedding, classification, tag decision and tag write) on a synthetic corpus
+# generated locally with ffmpeg. Results are saved as JSON, and a run can be
+# compared against an earlier one to catch performance regressions.
+
+# --- CONFIGURATION ---
+CORPUS_DIR = os.path.join(tagger.STATE_DIR, "bench_corpus")
+RESULTS_DIR = os.path.join(tagger.STATE_DIR, "benchmarks")
+CORPUS_FILES = 24
+CORPUS_FORMATS = ("mp3", "flac", "m4a")
+CORPUS_DURATIONS = (8, 45, 180, 420)  # Seconds, cycled through the corpus
+EXISTING_GROUPING = "Rock; mood_sad"  # Tags already in every file, so writes go through the merge path
+TOLERANCE = 0.10  # Slowdown of a stage's median that counts as a regression
+NOISE_FLOOR_MS = 1.0  # Differences below this are never reported as regressions
+
+ENCODERS = {"mp3": ["-c:a", "libmp3lame", "-b:a", "192k"], "flac": ["-c:a", "flac"], "m4a": ["-c:a", "aac", "-b:a", "192k"]}
+
+# --- STUB MODELS (used when the .pb files are absent) ---
+class StubEmbeddingModel:
+    """Stand-in for TensorflowPredictEffnetDiscogs: one 1280-d vector per second of audio"""
+
+    def __init__(self, dim=1280, seed=0):
+        self.projection = np.random.default_rng(seed).standard_normal((160, dim)).astype(np.float32)
+
+    def __call__(self, audio):
+        seconds = max(1, len(audio) // 16000)
+        frames = np.resize(np.asarray(audio, dtype=np.float32), seconds * 16000).reshape(seconds, 160, 100)
+        return np.tanh(np.abs(frames).mean(axis=2) @ self.projection)
+
+class StubClassifierModel:
+    """Stand-in for TensorflowPredict2D: sigmoid of a fixed projection of the embeddings"""
+
+    def __init__(self, classes, dim=1280, seed=1):
+        self.projection = np.random.default_rng(seed).standard_normal((dim, classes)).astype(np.float32) * 0.05
+
+    def __call__(self, embeddings):
+        return 1 / (1 + np.exp(-(np.atleast_2d(embeddings) @ self.projection) + 2))
+
+def models_available():
+    return os.path.exists(tagger.EMBEDDING_MODEL_FILE) and os.path.exists(tagger.CLASSIFIER_MODEL_FILE)
+
+# --- CORPUS ---
+def corpus_spec(files):
+    return [{"name": f"bench_{n:03d}.{CORPUS_FORMATS[n % len(CORPUS_FORMATS)]}",
+             "duration": CORPUS_DURATIONS[n % len(CORPUS_DURATIONS)], "seed": n} for n in range(files)]
+
+def write_grouping(path, value):
+    # Same tag fields the tagger writes, so the benchmark exercises the merge path
+    if path.endswith(".mp3"):
+        tags = ID3()
+        tags["TIT1"] = TIT1(encoding=3, text=value)
+        tags.save(path)
+    elif path.endswith(".flac"):
+        audio = FLAC(path)
+        audio["GROUPING"] = [t.strip() for t in value.split(";")]
+        audio.save()
+    else:
+        audio = MP4(path)
+        if audio.tags is None: audio.add_tags()
+        audio.tags["\xa9grp"] = [value]
+        audio.save()
+
+def generate_corpus(directory, files):
+    """Create (or reuse) the synthetic corpus: pink noise over a tone, per file seed and length"""
+    spec = corpus_spec(files)
+    spec_file = os.path.join(directory, "corpus.json")
+    try:
+        with open(spec_file, 'r') as f:
+            if json.load(f) == spec: return spec
+    except (OSError, ValueError):
+        pass
+
+    print(f"Generating {files} synthetic files in {directory}...")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for entry in spec:
+        path = os.path.join(directory, entry["name"])
+        duration, seed = entry["duration"], entry["seed"]
+        command = [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f"anoisesrc=d={duration}:c=pink:r=44100:a=0.3:seed={seed}",
+            '-f', 'lavfi', '-i', f"sine=f={220 + 55 * (seed % 8)}:d={duration}:r=44100",
+            '-filter_complex', 'amix=inputs=2', '-ac', '2'
+        ] + ENCODERS[entry["name"].rsplit(".", 1)[1]] + [path]
+        subprocess.run(command, check=True)
+        write_grouping(path, EXISTING_GROUPING)
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f)
+    return spec
+
+# --- BENCHMARK ---
+def environment(decoder, stub):
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except OSError: commit = ""
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "decoder": decoder, "models": "stub" if stub else "real"}
+
+def run_benchmark(paths, classes, decoder, stub, repeat):
+    if stub:
+        embedding_model, classifier_model = StubEmbeddingModel(), StubClassifierModel(len(classes))
+    else:
+        embedding_model, classifier_model = tagger.load_models()
+    rules = tagger.get_tag_rules(classes)
+    metrics = Metrics()
+
+    # Warm up the models so graph initialisation is not counted against the first file
+    warmup = np.zeros(tagger.CHUNK_DURATION * 16000, dtype=np.float32)
+    classifier_model(np.mean(embedding_model(warmup), axis=0)[np.newaxis])
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        for _ in range(repeat):
+            for path in paths:
+                timings = {}
+                with stage(timings, "probe"):
+                    duration = tagger.probe_duration(path, decoder)
+                start_time = max(0, (duration / 2) - (tagger.CHUNK_DURATION / 2))
+                with stage(timings, "decode"):
+                    try: audio = tagger.DECODERS[decoder](path, start_time, tagger.CHUNK_DURATION)
+                    except Exception: audio = None
+                if audio is None or len(audio) < 16000:
+                    metrics.count("decode_error" if audio is None else "short_audio")
+                    metrics.record(path, "skipped", timings)
+                    continue
+                with stage(timings, "embedding"):
+                    embedding = np.mean(embedding_model(audio), axis=0)
+                with stage(timings, "classifier"):
+                    predictions = classifier_model(embedding[np.newaxis])
+                with stage(timings, "decision"):
+                    tags, _ = rules.decide(predictions)[0]
+
+                # Write to a fresh copy so every repeat starts from the same file
+                copy = os.path.join(workdir, os.path.basename(path))
+                shutil.copyfile(path, copy)
+                with contextlib.redirect_stdout(io.StringIO()), stage(timings, "write"):
+                    outcome = tagger.append_tags_to_file(copy, tags or ["mood_bench"])
+                metrics.count(f"write_{outcome['action']}")
+                metrics.record(path, "ok", timings)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = metrics.summary()
+    for timing in summary["stages"].values():
+        # Stages run one file at a time, so throughput is the inverse of the mean latency
+        timing["files_per_s"] = round(1000 / timing["mean_ms"], 3) if timing["mean_ms"] > 0 else None
+    return summary
+
+def print_summary(summary):
+    print(f"{'Stage':<12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'files/s':>10}")
+    for name, timing in summary["stages"].items():
+        rate = f"{timing['files_per_s']:.1f}" if timing["files_per_s"] else "-"
+        print(f"{name:<12}{timing['p50_ms']:>10.1f}{timing['p90_ms']:>10.1f}{timing['p99_ms']:>10.1f}{rate:>10}")
+
+def compare(baseline, current, tolerance=TOLERANCE):
+    """Print the change of every stage's median; return the stages that regressed"""
+    if baseline["environment"]["models"] != current["environment"]["models"]:
+        print(f"Warning: comparing {baseline['environment']['models']} models against {current['environment']['models']} models.")
+    print(f"Compared with {baseline.get('timestamp', '?')} ({baseline['environment'].get('commit') or 'unknown commit'}):")
+    print(f"{'Stage':<12}{'baseline':>12}{'current':>12}{'change':>10}")
+    regressions = []
+    for name, timing in current["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None: continue
+        old, new = before["p50_ms"], timing["p50_ms"]
+        change = (new - old) / old if old > 0 else 0.0
+        regressed = new - old > NOISE_FLOOR_MS and change > tolerance
+        if regressed: regressions.append(name)
+        print(f"{name:<12}{old:>10.1f}ms{new:>10.1f}ms{change*100:>+9.1f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+# --- MAIN ---
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tagger stages on a synthetic corpus.")
+    parser.add_argument("--files", type=int, default=CORPUS_FILES, help="Files in the synthetic corpus")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="Where the synthetic corpus is generated and kept")
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the corpus")
+    parser.add_argument("--decoder", choices=sorted(tagger.DECODERS), default=tagger.DECODER, help="Audio decoder to benchmark")
+    parser.add_argument("--stub-models", action="store_true", help="Use stand-in models even when the .pb files are present")
+    parser.add_argument("--output", help="Results file (default: a timestamped file in the benchmarks folder)")
+    parser.add_argument("--compare", metavar="FILE", help="Earlier results to compare against; exits with status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed slowdown of a stage's median (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    print("--- Music Mood Tagger Benchmark ---")
+    with open(tagger.META_FILE, 'r') as f:
+        classes = json.load(f)['classes']
+    stub = args.stub_models or not models_available()
+    if stub:
+        print("Using stub models (timings of the model stages are not representative).")
+
+    spec = generate_corpus(args.corpus, args.files)
+    paths = [os.path.join(args.corpus, entry["name"]) for entry in spec]
+    print(f"Benchmarking {len(paths)} files x {args.repeat} with the {args.decoder} decoder...")
+    summary = run_benchmark(paths, classes, args.decoder, stub, args.repeat)
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    results = {"timestamp": timestamp, "environment": environment(args.decoder, stub),
+               "corpus": {"files": args.files, "repeat": args.repeat}}
+    results.update(summary)
+    print_summary(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{timestamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print(f"Regression in: {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions.")
+
+if __name__ == "__main__":
+    main()
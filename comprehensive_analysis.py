@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import os
 import json
-from collections import defaultdict, Counter
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, Counter, deque
 from mutagen.mp4 import MP4
 from mutagen.flac import FLAC
 from mutagen.id3 import ID3
-import sys
+from tag_rules import TagRules
+from matrix_store import load_matrix
+from duplicates import load_clusters
+from discovery import AUDIO_EXTENSIONS, iter_audio_files, parse_extensions, Progress
 
 # Current thresholds from tagger.py
 TAG_CONFIG = {
@@ -84,11 +90,31 @@ FALLBACK_OVERRIDES = {
     "inspiring": 0.08, "hopeful": 0.08, "motivational": 0.10,
 }
 
-MUSIC_FOLDER = sys.argv[1] if len(sys.argv) > 1 else "/Users/alessiolaiso/Downloads/Converted"
+FALLBACK_THRESHOLD = 0.06
+MAX_TAGS = 5
 
-def get_tags_from_file(filepath):
-    """Extract mood tags from audio file"""
+MUSIC_FOLDER = "/Users/alessiolaiso/Downloads/Converted"
+SCORES_DIR = "/app/.tagger/scores"  # Written by tagger.py
+METADATA_INDEX = "/app/.tagger/metadata_index.sqlite"  # Tags and titles from previous scans
+DUPLICATES_FILE = "/app/.tagger/duplicates.sqlite"  # Written by tagger.py
+SCAN_WORKERS = 16  # Files read in parallel (mostly waiting on storage)
+READ_AHEAD = 4  # Files queued per worker while scanning
+PROGRESS_INTERVAL = 10  # Seconds between progress lines
+
+# Define all expected output tags
+all_tags = [
+    "mood_happy", "mood_sad", "mood_love", "mood_dark", "mood_emotional",
+    "mood_deep", "mood_energetic", "mood_relaxing", "mood_heavy",
+    "mood_party", "mood_meditative", "mood_atmospheric", "mood_groovy",
+    "mood_summer", "mood_cinematic", "mood_epic", "mood_inspiring", "mood_melodic",
+    "mood_ballad"
+]
+
+def read_metadata(filepath):
+    """Extract mood tags and "artist - title" from an audio file in a single parse"""
     ext = filepath.lower()
+    tags = []
+    title = artist = None
 
     try:
         if ext.endswith(".m4a") or ext.endswith(".mp4"):
@@ -96,197 +122,345 @@ def get_tags_from_file(filepath):
             grouping = audio.tags.get("\xa9grp", [])
             if grouping:
                 tags = [t.strip() for t in grouping[0].split(";")]
-                return [t for t in tags if t.startswith("mood_")]
+            title = audio.tags.get("\xa9nam", [""])[0]
+            artist = audio.tags.get("\xa9ART", [""])[0]
         elif ext.endswith(".flac"):
             audio = FLAC(filepath)
-            grouping = audio.get("GROUPING", [])
-            return [t for t in grouping if t.startswith("mood_")]
+            tags = audio.get("GROUPING", [])
+            title = audio.get("TITLE", [""])[0]
+            artist = audio.get("ARTIST", [""])[0]
         elif ext.endswith(".mp3"):
             audio = ID3(filepath)
             tit1 = audio.getall("TIT1")
             if tit1:
                 tags = [t.strip() for t in tit1[0].text[0].split(";")]
-                return [t for t in tags if t.startswith("mood_")]
-    except Exception as e:
-        pass
-
-    return []
-
-def get_song_title(filepath):
-    """Extract song title from audio file"""
-    ext = filepath.lower()
-
-    try:
-        if ext.endswith(".m4a") or ext.endswith(".mp4"):
-            audio = MP4(filepath)
-            title = audio.tags.get("\xa9nam", [""])
-            artist = audio.tags.get("\xa9ART", [""])
-            if title[0] and artist[0]:
-                return f"{artist[0]} - {title[0]}"
-            elif title[0]:
-                return title[0]
-        elif ext.endswith(".flac"):
-            audio = FLAC(filepath)
-            title = audio.get("TITLE", [""])
-            artist = audio.get("ARTIST", [""])
-            if title[0] and artist[0]:
-                return f"{artist[0]} - {title[0]}"
-            elif title[0]:
-                return title[0]
-        elif ext.endswith(".mp3"):
-            audio = ID3(filepath)
-            title = audio.get("TIT2", None)
-            artist = audio.get("TPE1", None)
-            if title and artist:
-                return f"{artist.text[0]} - {title.text[0]}"
-            elif title:
-                return title.text[0]
+            if audio.get("TIT2", None): title = audio["TIT2"].text[0]
+            if audio.get("TPE1", None): artist = audio["TPE1"].text[0]
     except Exception:
         pass
 
+    tags = [t for t in tags if t.startswith("mood_")]
+    if title and artist:
+        return tags, f"{artist} - {title}"
+    elif title:
+        return tags, title
     # Fallback to filename
-    return os.path.splitext(os.path.basename(filepath))[0]
-
-# Scan all files
-print(f"Scanning {MUSIC_FOLDER}...")
-tag_counts = Counter()
-tag_to_songs = defaultdict(list)
-total_files = 0
-tagged_files = 0
+    return tags, os.path.splitext(os.path.basename(filepath))[0]
 
-# Define all expected output tags
-all_tags = [
-    "mood_happy", "mood_sad", "mood_love", "mood_dark", "mood_emotional",
-    "mood_deep", "mood_energetic", "mood_relaxing", "mood_heavy",
-    "mood_party", "mood_meditative", "mood_atmospheric", "mood_groovy",
-    "mood_summer", "mood_cinematic", "mood_epic", "mood_inspiring", "mood_melodic",
-    "mood_ballad"
-]
-
-for root, dirs, files in os.walk(MUSIC_FOLDER):
-    for file in files:
-        if file.lower().endswith(('.mp3', '.flac', '.m4a', '.mp4')):
+def open_metadata_index(index_file):
+    """SQLite index of previously read metadata, None if it can't be created"""
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        db = sqlite3.connect(index_file)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, tags TEXT, title TEXT)"
+        )
+        return db
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: metadata index unavailable ({e}), reading every file.")
+        return None
+
+def scan_library(folder, index_file=METADATA_INDEX, workers=SCAN_WORKERS, extensions=AUDIO_EXTENSIONS, include=(), exclude=()):
+    """Count mood tags written in the files of a library"""
+    paths = []
+    progress = Progress("Scanned", PROGRESS_INTERVAL)
+
+    def discover():
+        for path in iter_audio_files(folder, extensions, include, exclude):
+            paths.append(path)
+            progress.add()
+            yield path
+        progress.finish_discovery()
+
+    db = open_metadata_index(index_file) if index_file else None
+    known = {}
+    if db is not None:
+        known = {row[0]: row[1:] for row in db.execute("SELECT path, size, mtime_ns, tags, title FROM files")}
+
+    def read(path):
+        # Only re-read files whose size or modification time changed
+        try: st = os.stat(path)
+        except OSError: return None
+        entry = known.get(path)
+        if entry and entry[:2] == (st.st_size, st.st_mtime_ns):
+            return json.loads(entry[2]), entry[3], None
+        tags, title = read_metadata(path)
+        return tags, title, (path, st.st_size, st.st_mtime_ns, json.dumps(tags), title)
+
+    tag_counts = Counter()
+    tag_to_songs = defaultdict(list)
+    total_files = 0
+    tagged_files = 0
+    updates = []
+
+    def read_all(pool):
+        # In order, with only a few files per worker in flight (pool.map would submit the whole library up front)
+        pending = deque()
+        for path in discover():
+            pending.append(pool.submit(read, path))
+            if len(pending) >= workers * READ_AHEAD:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in read_all(pool):
+            progress.advance()
+            if entry is None: continue
+            tags, title, update = entry
             total_files += 1
-            full_path = os.path.join(root, file)
-            tags = get_tags_from_file(full_path)
+            if update: updates.append(update)
 
             if tags:
                 tagged_files += 1
-                title = get_song_title(full_path)
-
                 for tag in tags:
                     tag_counts[tag] += 1
                     tag_to_songs[tag].append(title)
 
-# Generate report
-print(f"\nTotal files processed: {total_files}")
-print(f"Files with mood tags: {tagged_files} ({tagged_files/total_files*100:.1f}%)")
-print(f"Files without mood tags: {total_files - tagged_files}\n")
-
-print("="*80)
-print("TAG DISTRIBUTION & SAMPLE SONGS")
-print("="*80)
-
-# Sort by count
-sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
-
-for tag, count in sorted_tags:
-    percentage = (count / total_files * 100)
-    print(f"\n{tag.upper()}")
-    print(f"  Count: {count} songs ({percentage:.1f}% of library)")
-    print(f"  Sample songs (showing 20):")
-
-    for i, song in enumerate(tag_to_songs[tag][:20], 1):
-        print(f"    {i}. {song}")
-
-# Show tags with zero songs
-print("\n" + "="*80)
-print("TAGS WITH ZERO SONGS")
-print("="*80)
-for tag in all_tags:
-    if tag not in tag_counts:
-        print(f"  {tag}")
-
-# Generate statistics for analysis
-print("\n" + "="*80)
-print("THRESHOLD ANALYSIS")
-print("="*80)
-
-# Get reverse mapping of thresholds
-tag_thresholds = {}
-for raw_tag, (mood_tag, threshold) in TAG_CONFIG.items():
-    if mood_tag not in tag_thresholds:
-        tag_thresholds[mood_tag] = []
-    tag_thresholds[mood_tag].append((raw_tag, threshold))
-
-print("\nCurrent thresholds for each mood tag:")
-for mood_tag in sorted(all_tags):
-    if mood_tag in tag_thresholds:
-        print(f"\n{mood_tag}:")
-        for raw_tag, threshold in sorted(tag_thresholds[mood_tag]):
-            fallback = FALLBACK_OVERRIDES.get(raw_tag)
-            if fallback:
-                print(f"  {raw_tag}: {threshold*100:.0f}% (fallback: {fallback*100:.0f}%)")
-            else:
-                print(f"  {raw_tag}: {threshold*100:.0f}%")
-
-print("\n" + "="*80)
-print("ANALYSIS SUMMARY")
-print("="*80)
-print(f"\nTotal unique tags found: {len(tag_counts)}/{len(all_tags)}")
-print(f"Most common tag: {sorted_tags[0][0]} ({sorted_tags[0][1]} songs)")
-print(f"Least common tag: {sorted_tags[-1][0]} ({sorted_tags[-1][1]} songs)")
-
-# Calculate distribution metrics
-counts = [count for _, count in sorted_tags]
-avg_count = sum(counts) / len(counts)
-print(f"Average songs per tag: {avg_count:.1f}")
-print(f"Median songs per tag: {sorted(counts)[len(counts)//2]}")
-
-# Tag concentration
-top_5_percentage = sum([count for _, count in sorted_tags[:5]]) / sum(counts) * 100
-print(f"\nTop 5 tags represent {top_5_percentage:.1f}% of all tag assignments")
-
-print("\n" + "="*80)
-print("RECOMMENDATIONS")
-print("="*80)
-
-# Analyze over/under represented tags
-print("\nOVER-REPRESENTED TAGS (may need threshold increase):")
-for tag, count in sorted_tags[:5]:
-    if count > avg_count * 1.5:
-        print(f"  {tag}: {count} songs ({count/avg_count:.1f}x average)")
-
-print("\nUNDER-REPRESENTED TAGS (may need threshold decrease):")
-for tag, count in sorted_tags[-5:]:
-    if count < avg_count * 0.3:
-        print(f"  {tag}: {count} songs ({count/avg_count:.2f}x average)")
-
-# Save full song lists to file
-output_file = "/app/mood_analysis_report.md"
-with open(output_file, 'w') as f:
-    f.write("# Mood Tag Analysis Report\n\n")
-    f.write(f"**Total files:** {total_files}\n")
-    f.write(f"**Files with mood tags:** {tagged_files} ({tagged_files/total_files*100:.1f}%)\n\n")
-
-    f.write("## Tag Distribution\n\n")
+    if db is not None:
+        db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", updates)
+        gone = [p for p in set(known) - set(paths) if not os.path.exists(p)]
+        db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in gone])
+        db.commit()
+        db.close()
+        print(f"Read {len(updates)} changed files, {total_files - len(updates)} from the metadata index.")
+
+    return tag_counts, tag_to_songs, total_files, tagged_files
+
+def threshold_table(tag_config):
+    """Reverse mapping: output tag -> [(raw tag, threshold)]"""
+    tag_thresholds = {}
+    for raw_tag, (mood_tag, threshold) in tag_config.items():
+        if mood_tag not in tag_thresholds:
+            tag_thresholds[mood_tag] = []
+        tag_thresholds[mood_tag].append((raw_tag, threshold))
+    return tag_thresholds
+
+def print_report(tag_counts, tag_to_songs, total_files, tagged_files, tag_config=TAG_CONFIG, fallback_overrides=FALLBACK_OVERRIDES):
+    """Console report: distribution, thresholds, summary and recommendations"""
+    print(f"\nTotal files processed: {total_files}")
+    print(f"Files with mood tags: {tagged_files} ({tagged_files/total_files*100:.1f}%)")
+    print(f"Files without mood tags: {total_files - tagged_files}\n")
+
+    print("="*80)
+    print("TAG DISTRIBUTION & SAMPLE SONGS")
+    print("="*80)
+
+    # Sort by count
+    sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
+
     for tag, count in sorted_tags:
         percentage = (count / total_files * 100)
-        f.write(f"### {tag.upper()} - {count} songs ({percentage:.1f}%)\n\n")
+        print(f"\n{tag.upper()}")
+        print(f"  Count: {count} songs ({percentage:.1f}% of library)")
+        print(f"  Sample songs (showing 20):")
+
         for i, song in enumerate(tag_to_songs[tag][:20], 1):
-            f.write(f"{i}. {song}\n")
-        f.write("\n")
+            print(f"    {i}. {song}")
+
+    # Show tags with zero songs
+    print("\n" + "="*80)
+    print("TAGS WITH ZERO SONGS")
+    print("="*80)
+    for tag in all_tags:
+        if tag not in tag_counts:
+            print(f"  {tag}")
+
+    # Generate statistics for analysis
+    print("\n" + "="*80)
+    print("THRESHOLD ANALYSIS")
+    print("="*80)
+
+    # Get reverse mapping of thresholds
+    tag_thresholds = threshold_table(tag_config)
 
-    f.write("\n## Current Threshold Configuration\n\n")
+    print("\nCurrent thresholds for each mood tag:")
     for mood_tag in sorted(all_tags):
         if mood_tag in tag_thresholds:
-            f.write(f"### {mood_tag}\n")
+            print(f"\n{mood_tag}:")
             for raw_tag, threshold in sorted(tag_thresholds[mood_tag]):
-                fallback = FALLBACK_OVERRIDES.get(raw_tag)
+                fallback = fallback_overrides.get(raw_tag)
                 if fallback:
-                    f.write(f"- {raw_tag}: {threshold*100:.0f}% (fallback: {fallback*100:.0f}%)\n")
+                    print(f"  {raw_tag}: {threshold*100:.0f}% (fallback: {fallback*100:.0f}%)")
                 else:
-                    f.write(f"- {raw_tag}: {threshold*100:.0f}%\n")
+                    print(f"  {raw_tag}: {threshold*100:.0f}%")
+
+    print("\n" + "="*80)
+    print("ANALYSIS SUMMARY")
+    print("="*80)
+    print(f"\nTotal unique tags found: {len(tag_counts)}/{len(all_tags)}")
+    print(f"Most common tag: {sorted_tags[0][0]} ({sorted_tags[0][1]} songs)")
+    print(f"Least common tag: {sorted_tags[-1][0]} ({sorted_tags[-1][1]} songs)")
+
+    # Calculate distribution metrics
+    counts = [count for _, count in sorted_tags]
+    avg_count = sum(counts) / len(counts)
+    print(f"Average songs per tag: {avg_count:.1f}")
+    print(f"Median songs per tag: {sorted(counts)[len(counts)//2]}")
+
+    # Tag concentration
+    top_5_percentage = sum([count for _, count in sorted_tags[:5]]) / sum(counts) * 100
+    print(f"\nTop 5 tags represent {top_5_percentage:.1f}% of all tag assignments")
+
+    print("\n" + "="*80)
+    print("RECOMMENDATIONS")
+    print("="*80)
+
+    # Analyze over/under represented tags
+    print("\nOVER-REPRESENTED TAGS (may need threshold increase):")
+    for tag, count in sorted_tags[:5]:
+        if count > avg_count * 1.5:
+            print(f"  {tag}: {count} songs ({count/avg_count:.1f}x average)")
+
+    print("\nUNDER-REPRESENTED TAGS (may need threshold decrease):")
+    for tag, count in sorted_tags[-5:]:
+        if count < avg_count * 0.3:
+            print(f"  {tag}: {count} songs ({count/avg_count:.2f}x average)")
+
+def write_markdown_report(output_file, tag_counts, tag_to_songs, total_files, tagged_files):
+    """Save full song lists to file"""
+    sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
+    tag_thresholds = threshold_table(TAG_CONFIG)
+
+    with open(output_file, 'w') as f:
+        f.write("# Mood Tag Analysis Report\n\n")
+        f.write(f"**Total files:** {total_files}\n")
+        f.write(f"**Files with mood tags:** {tagged_files} ({tagged_files/total_files*100:.1f}%)\n\n")
+
+        f.write("## Tag Distribution\n\n")
+        for tag, count in sorted_tags:
+            percentage = (count / total_files * 100)
+            f.write(f"### {tag.upper()} - {count} songs ({percentage:.1f}%)\n\n")
+            for i, song in enumerate(tag_to_songs[tag][:20], 1):
+                f.write(f"{i}. {song}\n")
             f.write("\n")
 
-print(f"\nFull report saved to: {output_file}")
+        f.write("\n## Current Threshold Configuration\n\n")
+        for mood_tag in sorted(all_tags):
+            if mood_tag in tag_thresholds:
+                f.write(f"### {mood_tag}\n")
+                for raw_tag, threshold in sorted(tag_thresholds[mood_tag]):
+                    fallback = FALLBACK_OVERRIDES.get(raw_tag)
+                    if fallback:
+                        f.write(f"- {raw_tag}: {threshold*100:.0f}% (fallback: {fallback*100:.0f}%)\n")
+                    else:
+                        f.write(f"- {raw_tag}: {threshold*100:.0f}%\n")
+                f.write("\n")
+
+    print(f"\nFull report saved to: {output_file}")
+
+def load_candidate_config(config_file):
+    """Candidate thresholds (JSON), merged over the current configuration.
+
+    Keys: tag_config ({raw_tag: [display_tag, threshold]}, null removes a tag),
+    fallback_overrides, ignored_tags, fallback_threshold, max_tags.
+    """
+    with open(config_file, 'r') as f:
+        candidate = json.load(f)
+
+    tag_config = dict(TAG_CONFIG)
+    for raw_tag, value in candidate.get("tag_config", {}).items():
+        if value is None: tag_config.pop(raw_tag, None)
+        else: tag_config[raw_tag] = tuple(value)
+    fallback_overrides = dict(FALLBACK_OVERRIDES)
+    fallback_overrides.update(candidate.get("fallback_overrides", {}))
+
+    return {
+        "tag_config": tag_config,
+        "ignored_tags": set(candidate.get("ignored_tags", IGNORED_TAGS)),
+        "fallback_overrides": fallback_overrides,
+        "fallback_threshold": candidate.get("fallback_threshold", FALLBACK_THRESHOLD),
+        "max_tags": candidate.get("max_tags", MAX_TAGS),
+    }
+
+def what_if(config_file, scores_dir):
+    """Recompute the tag distribution for a candidate config from the stored scores"""
+    stored = load_matrix(scores_dir)
+    if stored is None:
+        print(f"Error: No stored scores in {scores_dir}, run tagger.py first.")
+        exit(1)
+    paths, scores, classes = stored
+    candidate = load_candidate_config(config_file)
+    print(f"Evaluating {config_file} on {len(paths)} stored tracks...")
+
+    current_rules = TagRules(classes, TAG_CONFIG, IGNORED_TAGS, FALLBACK_OVERRIDES, FALLBACK_THRESHOLD, MAX_TAGS)
+    candidate_rules = TagRules(classes, candidate["tag_config"], candidate["ignored_tags"],
+                               candidate["fallback_overrides"], candidate["fallback_threshold"], candidate["max_tags"])
+    current = current_rules.decide(scores)
+    proposed = candidate_rules.decide(scores)
+
+    tag_counts = Counter()
+    tag_to_songs = defaultdict(list)
+    tagged_files = 0
+    added = Counter()
+    removed = Counter()
+    current_counts = Counter()
+    changed_files = 0
+    for path, (current_tags, _), (new_tags, _) in zip(paths, current, proposed):
+        title = os.path.splitext(os.path.basename(path))[0]
+        if new_tags:
+            tagged_files += 1
+        for tag in new_tags:
+            tag_counts[tag] += 1
+            tag_to_songs[tag].append(title)
+        current_counts.update(current_tags)
+        added.update(set(new_tags) - set(current_tags))
+        removed.update(set(current_tags) - set(new_tags))
+        if set(new_tags) != set(current_tags):
+            changed_files += 1
+
+    print_report(tag_counts, tag_to_songs, len(paths), tagged_files, candidate["tag_config"], candidate["fallback_overrides"])
+
+    print("\n" + "="*80)
+    print("DIFF AGAINST CURRENT THRESHOLDS")
+    print("="*80)
+    print(f"\nFiles whose tags would change: {changed_files} ({changed_files/len(paths)*100:.1f}%)")
+    print(f"\n  {'tag':<20}{'current':>10}{'candidate':>12}{'added':>10}{'removed':>10}")
+    for tag in sorted(set(current_counts) | set(tag_counts) | set(all_tags)):
+        print(f"  {tag:<20}{current_counts[tag]:>10}{tag_counts[tag]:>12}{'+' + str(added[tag]):>10}{'-' + str(removed[tag]):>10}")
+
+def report_duplicates(db_path):
+    """List the recordings tagger.py found in more than one file"""
+    clusters = load_clusters(db_path)
+    if clusters is None:
+        print(f"Error: No duplicates index at {db_path}, run tagger.py first.")
+        exit(1)
+    # Files deleted since the last tagger run are dropped from the index at its next scan
+    clusters = [[path for path in paths if os.path.exists(path)] for paths in clusters]
+    clusters = sorted((paths for paths in clusters if len(paths) > 1), key=lambda paths: (-len(paths), paths[0]))
+
+    print("\n" + "="*80)
+    print("DUPLICATE RECORDINGS")
+    print("="*80)
+    redundant = sum(len(paths) - 1 for paths in clusters)
+    print(f"\n{len(clusters)} recordings found in more than one file ({redundant} redundant copies)\n")
+    for paths in clusters:
+        print(f"{len(paths)} files:")
+        for path in paths:
+            print(f"   {path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse the mood tag distribution of a tagged library.")
+    parser.add_argument("folder", nargs="?", default=MUSIC_FOLDER, help="Music folder to scan")
+    parser.add_argument("--what-if", metavar="CONFIG", help="JSON file with candidate thresholds, evaluated on the scores stored by tagger.py instead of scanning files")
+    parser.add_argument("--duplicates", nargs="?", const=DUPLICATES_FILE, metavar="INDEX", help="List the recordings tagger.py found in several files (optionally from another duplicates index)")
+    parser.add_argument("--scores", default=SCORES_DIR, help="Directory of the scores stored by tagger.py")
+    parser.add_argument("--index", default=METADATA_INDEX, help="Metadata index reused between scans ('' to disable)")
+    parser.add_argument("--scan-workers", type=int, default=SCAN_WORKERS, help="Files read in parallel")
+    parser.add_argument("--ext", dest="extensions", type=parse_extensions, default=AUDIO_EXTENSIONS, help="Comma-separated file extensions to scan (default: mp3,flac,m4a,mp4)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB", help="Only scan files matching this glob (relative to the folder, repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="Skip files and folders matching this glob (repeatable)")
+    args = parser.parse_args()
+
+    if args.duplicates:
+        report_duplicates(args.duplicates)
+    elif args.what_if:
+        what_if(args.what_if, args.scores)
+    else:
+        # Scan all files
+        print(f"Scanning {args.folder}...")
+        tag_counts, tag_to_songs, total_files, tagged_files = scan_library(args.folder, args.index, args.scan_workers,
+                                                                     args.extensions, args.include, args.exclude)
+        print_report(tag_counts, tag_to_songs, total_files, tagged_files)
+        write_markdown_report("/app/mood_analysis_report.md", tag_counts, tag_to_songs, total_files, tagged_files)
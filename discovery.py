@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import fnmatch
+import threading
+
+# Lazy library discovery on os.scandir (no per-file stat calls for the walk
+# itself), plus a progress reporter for the loops consuming it.
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.m4a', '.mp4')
+
+def parse_extensions(value):
+    """'mp3,flac' -> ('.mp3', '.flac')"""
+    return tuple("." + ext.strip().lower().lstrip(".") for ext in value.split(",") if ext.strip())
+
+def iter_audio_files(root, extensions=AUDIO_EXTENSIONS, include=(), exclude=()):
+    """Yield audio files under root as they are found, in os.walk (top-down) order.
+
+    include/exclude are glob patterns matched against the path relative to
+    root; excluded directories are not descended into.
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative = os.path.relpath(entry.path, root)
+                    if any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                        continue
+                    try: is_dir = entry.is_dir()
+                    except OSError: continue
+                    if is_dir:
+                        # Like os.walk, symlinked directories are not descended into (they may loop)
+                        if not entry.is_symlink(): subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(extensions):
+                        if include and not any(fnmatch.fnmatch(relative, pattern) for pattern in include):
+                            continue
+                        yield entry.path
+        except OSError:
+            continue
+        stack.extend(reversed(subdirs))
+
+def matches_filters(path, root, extensions=AUDIO_EXTENSIONS, include=(), exclude=()):
+    """Whether iter_audio_files would yield path (for paths reported one by one, e.g. by file events)"""
+    if not path.lower().endswith(tuple(ext.lower() for ext in extensions)): return False
+    relative = os.path.relpath(path, root)
+    if relative.startswith(os.pardir): return False
+    # Excluding a folder excludes everything below it
+    parts = relative.split(os.sep)
+    for depth in range(1, len(parts) + 1):
+        if any(fnmatch.fnmatch(os.sep.join(parts[:depth]), pattern) for pattern in exclude): return False
+    return not include or any(fnmatch.fnmatch(relative, pattern) for pattern in include)
+
+class Progress:
+    """Files done/total, throughput and ETA, printed every few seconds"""
+
+    def __init__(self, label="Progress", interval=10.0, stream=None):
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.total = 0
+        self.done = 0
+        self.discovering = True
+        self.started = time.monotonic()
+        self._last_print = self.started
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        with self._lock:
+            self.total += count
+
+    def finish_discovery(self):
+        self.discovering = False
+
+    def advance(self, count=1):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self._last_print < self.interval: return
+            self._last_print = now
+        print(self.line(), file=self.stream, flush=True)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def line(self):
+        rate = self.rate()
+        total = f"{self.total}+" if self.discovering else str(self.total)
+        remaining = max(0, self.total - self.done)
+        eta = format_duration(remaining / rate) if rate > 0 else "?"
+        if self.discovering: eta = f">{eta}"
+        percent = f" ({self.done / self.total * 100:.1f}%)" if self.total and not self.discovering else ""
+        return f"[{self.label}: {self.done}/{total}{percent} | {rate:.2f} files/s | ETA {eta}]"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600: return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60: return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import numpy as np
+from prediction_cache import fingerprint_files
+
+# Acoustic fingerprints of the analysed chunks, to find the same recording in
+# several files (FLAC master, m4a transcode, compilation copy) and reuse its
+# predictions instead of running the models again. Unlike the prediction
+# cache key, the fingerprint survives lossy re-encoding and small time shifts.
+#
+# Fingerprint (after Haitsma & Kalker): per 32 ms frame, 32 bits telling
+# whether the energy difference between adjacent bands (300-3000 Hz) grew or
+# shrank since the previous frame. Lossy codecs flip a few of those bits, so
+# lookups use coarser words (fewer bands, smoothed over time) that mostly
+# survive re-encoding unchanged: every INDEX_EVERY-th one is indexed, and
+# candidates voted for by exact word matches at a consistent time offset are
+# confirmed by the bit error rate of the full fingerprints.
+
+SAMPLE_RATE = 16000
+FRAME_SIZE = 4096
+HOP_SIZE = 512
+BANDS = 33  # 32 bits per frame
+MIN_FREQUENCY, MAX_FREQUENCY = 300, 3000
+INDEX_SMOOTHING = 16  # Frames averaged for the lookup words
+INDEX_BITS = 20  # Bits per lookup word (from INDEX_BITS + 1 merged bands)
+INDEX_STEP = 8  # Frames between the two energy differences a lookup word compares
+INDEX_EVERY = 16  # Lookup words stored per recording: one every INDEX_EVERY frames
+MIN_VOTES = 3  # Exact word matches at the same offset needed to consider a candidate
+MIN_OVERLAP = 150  # Overlapping frames (~5 s) needed to compare two fingerprints
+MAX_BIT_ERROR = 0.15  # Bit error rate under which two chunks are the same recording (unrelated audio: ~0.5)
+
+CLUSTERS_QUERY = ("SELECT recording, path FROM files WHERE recording IN "
+                  "(SELECT recording FROM files GROUP BY recording HAVING COUNT(*) > 1) ORDER BY recording, path")
+
+_band_matrix = None
+
+def band_matrix():
+    # Sums the FFT bins of each band (computed once)
+    global _band_matrix
+    if _band_matrix is None:
+        frequencies = np.fft.rfftfreq(FRAME_SIZE, 1 / SAMPLE_RATE)
+        edges = np.geomspace(MIN_FREQUENCY, MAX_FREQUENCY, BANDS + 1)
+        band = np.searchsorted(edges, frequencies, side="right") - 1
+        _band_matrix = np.zeros((len(frequencies), BANDS), dtype=np.float32)
+        inside = (band >= 0) & (band < BANDS)
+        _band_matrix[np.nonzero(inside)[0], band[inside]] = 1
+    return _band_matrix
+
+def energy_bits(energy, step):
+    # Whether each adjacent band difference grew over step frames
+    difference = energy[:, :-1] - energy[:, 1:]
+    return (difference[step:] - difference[:-step]) > 0
+
+def audio_fingerprint(audio):
+    """(fingerprint, lookup words) of 16 kHz mono audio, one uint32 per frame each; None if too short or too flat"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if len(audio) < FRAME_SIZE + HOP_SIZE * (MIN_OVERLAP + INDEX_SMOOTHING + INDEX_STEP): return None
+    frames = np.lib.stride_tricks.sliding_window_view(audio, FRAME_SIZE)[::HOP_SIZE] * np.hanning(FRAME_SIZE).astype(np.float32)
+    energy = (np.abs(np.fft.rfft(frames, axis=1)) ** 2) @ band_matrix()
+    bits = energy_bits(energy, 1)
+    # Silence and flat noise give (nearly) constant bits, which would match each other
+    if not 0.2 < bits.mean() < 0.8: return None
+    fingerprint = np.packbits(bits, axis=1, bitorder="little").view(np.uint32).ravel()
+
+    merged = np.add.reduceat(energy, [group[0] for group in np.array_split(np.arange(BANDS), INDEX_BITS + 1)], axis=1)
+    smoothed = np.lib.stride_tricks.sliding_window_view(merged, INDEX_SMOOTHING, axis=0).sum(axis=2)
+    words = energy_bits(smoothed, INDEX_STEP).astype(np.uint32) @ (1 << np.arange(INDEX_BITS, dtype=np.uint32))
+    return fingerprint, words
+
+def bit_error_rate(query, stored, offset):
+    """Share of differing bits between query[j] and stored[j + offset] over their overlap, None if too short"""
+    start, end = max(0, -offset), min(len(query), len(stored) - offset)
+    if end - start < MIN_OVERLAP: return None
+    differing = np.unpackbits((query[start:end] ^ stored[start + offset:end + offset]).view(np.uint8)).sum()
+    return differing / ((end - start) * 32)
+
+def group_clusters(rows):
+    groups = {}
+    for recording, path in rows:
+        groups.setdefault(recording, []).append(path)
+    return list(groups.values())
+
+def load_clusters(db_path):
+    """Paths of every recording found in more than one file, read-only; None if there is no index"""
+    if not os.path.exists(db_path): return None
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try: return group_clusters(db.execute(CLUSTERS_QUERY))
+    finally: db.close()
+
+class DuplicateIndex:
+    """SQLite index of recordings (fingerprint, embedding, predictions) and the files each was found in"""
+
+    def __init__(self, db_path, model_files, settings=""):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, fingerprint BLOB, embedding BLOB, predictions BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS words (word INTEGER, recording INTEGER, frame INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS words_word ON words (word)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS words_recording ON words (recording)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, recording INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_recording ON files (recording)")
+        self.invalidated = False
+
+        # Stored predictions are only valid for the models and analysis settings (chunk, windows) that produced them
+        models = fingerprint_files(model_files) + settings
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'models'").fetchone()
+        if row is None or row[0] != models:
+            self.invalidated = row is not None
+            for table in ("recordings", "words", "files"):
+                self.db.execute(f"DELETE FROM {table}")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('models', ?)", (models,))
+        self.db.commit()
+
+    def match(self, fingerprint, path=None):
+        """(recording id, embedding, predictions) of the recording this fingerprint belongs to, or None.
+        Recordings found only in path itself are skipped, so a re-analysed file runs the models again"""
+        if fingerprint is None: return None
+        fingerprint, lookup_words = fingerprint
+        frames = {}  # Word -> query frames it occurs at
+        for frame, word in enumerate(lookup_words.tolist()):
+            if word != 0: frames.setdefault(word, []).append(frame)
+        words = list(frames)
+        votes = {}
+        for i in range(0, len(words), 500):
+            chunk = words[i:i + 500]
+            rows = self.db.execute(f"SELECT word, recording, frame FROM words WHERE word IN ({','.join('?' * len(chunk))})", chunk)
+            for word, recording, stored_frame in rows:
+                for query_frame in frames[word]:
+                    key = (recording, stored_frame - query_frame)
+                    votes[key] = votes.get(key, 0) + 1
+
+        for (recording, offset), count in sorted(votes.items(), key=lambda item: -item[1]):
+            if count < MIN_VOTES: break
+            if self.db.execute("SELECT 1 FROM files WHERE recording = ? AND path IS NOT ? LIMIT 1", (recording, path)).fetchone() is None:
+                continue
+            stored, embedding, predictions = self.db.execute(
+                "SELECT fingerprint, embedding, predictions FROM recordings WHERE id = ?", (recording,)).fetchone()
+            error = bit_error_rate(fingerprint, np.frombuffer(stored, dtype=np.uint32), offset)
+            if error is not None and error <= MAX_BIT_ERROR:
+                return recording, np.frombuffer(embedding, dtype=np.float32), np.frombuffer(predictions, dtype=np.float32)
+        return None
+
+    def add(self, path, fingerprint, embedding, predictions):
+        """Store a newly analysed recording and the file it came from"""
+        if fingerprint is None: return None
+        fingerprint, lookup_words = fingerprint
+        cursor = self.db.execute("INSERT INTO recordings (fingerprint, embedding, predictions) VALUES (?, ?, ?)",
+                                 (fingerprint.tobytes(), np.asarray(embedding, dtype=np.float32).tobytes(),
+                                  np.asarray(predictions, dtype=np.float32).tobytes()))
+        recording = cursor.lastrowid
+        words = lookup_words.tolist()
+        self.db.executemany("INSERT INTO words VALUES (?, ?, ?)",
+                            [(words[frame], recording, frame) for frame in range(0, len(words), INDEX_EVERY) if words[frame] != 0])
+        self.link(path, recording)
+        return recording
+
+    def link(self, path, recording):
+        previous = self.db.execute("SELECT recording FROM files WHERE path = ?", (path,)).fetchone()
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (path, recording))
+        if previous and previous[0] != recording:
+            self._prune([previous[0]])  # The file was modified into another recording
+        self.db.commit()
+
+    def forget(self, paths):
+        paths = list(paths)
+        recordings = set()
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            recordings.update(row[0] for row in self.db.execute(
+                f"SELECT recording FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+        self._prune(recordings)
+        self.db.commit()
+
+    def _prune(self, recordings):
+        # Drop recordings no file refers to any more, so the index does not outgrow the library
+        orphans = [(r,) for r in recordings
+                   if self.db.execute("SELECT 1 FROM files WHERE recording = ? LIMIT 1", (r,)).fetchone() is None]
+        self.db.executemany("DELETE FROM words WHERE recording = ?", orphans)
+        self.db.executemany("DELETE FROM recordings WHERE id = ?", orphans)
+
+    def clusters(self):
+        """Paths of every recording found in more than one file"""
+        return group_clusters(self.db.execute(CLUSTERS_QUERY))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+from matrix_store import MatrixStore
+
+# Nearest-neighbour search over the track embeddings stored by tagger.py: one
+# L2-normalised float16 row per track, so cosine similarity is a dot product.
+# Converting the float16 rows dominates an exact scan (~0.2 s per 100k tracks),
+# so from PROJECTED_MIN_ROWS tracks on, a projection of every row onto its top
+# PROJECTED_DIM principal directions (float32) picks CANDIDATES rows, which are
+# then ranked with the full embeddings. After each tagging run the rows added
+# or changed since are projected and appended to a raw float32 file; every row
+# is only projected again when the basis is refit. Rows added since are
+# scanned exactly.
+
+PROJECTED_DIM = 128
+CANDIDATES = 1000  # Rows re-ranked with the full embeddings
+PROJECTED_MIN_ROWS = 20000  # Smaller libraries are always scanned exactly
+PCA_SAMPLE = 20000  # Rows the projection is fitted on
+REFIT_GROWTH = 2.0  # Refit once the library grew this much since the last fit
+CHUNK_ROWS = 8192  # Rows converted to float32 at a time
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def project_rows(matrix, basis):
+    # matrix @ basis, converted to float32 a chunk at a time
+    out = np.empty((len(matrix), basis.shape[1]), dtype=np.float32)
+    for i in range(0, len(matrix), CHUNK_ROWS):
+        out[i:i + CHUNK_ROWS] = matrix[i:i + CHUNK_ROWS].astype(np.float32) @ basis
+    return out
+
+def top_rows(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0: return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+class EmbeddingIndex:
+    """Read-only view of the stored embeddings with k-nearest-neighbour queries"""
+
+    def __init__(self, directory):
+        meta = MatrixStore._read_index(directory)
+        if meta is None: raise FileNotFoundError(f"No stored embeddings in {directory}")
+        self.directory = directory
+        self.paths = meta["paths"]
+        self.rows = {path: row for row, path in enumerate(self.paths) if path is not None}
+        self.deleted = np.array([path is None for path in self.paths], dtype=bool)
+        matrix = np.memmap(os.path.join(directory, "matrix.bin"), dtype=np.dtype(meta["dtype"]), mode='r')
+        self.matrix = matrix[:len(self.paths) * meta["dim"]].reshape(-1, meta["dim"])
+        self.basis, self.projected = self._load_projection()
+
+    def _load_projection(self):
+        # A projection covers the rows that existed when it was built
+        try:
+            with np.load(os.path.join(self.directory, "projection.npz")) as saved:
+                basis, generation = saved["basis"], int(saved["generation"])
+            projected_file = os.path.join(self.directory, f"projected-{generation}.f32")
+            # Whole rows only: the tagger may be appending to it
+            rows = os.path.getsize(projected_file) // (basis.shape[1] * 4)
+            projected = np.memmap(projected_file, dtype=np.float32, mode='r', shape=(rows, basis.shape[1])) if rows else None
+        except (OSError, ValueError, KeyError):
+            return None, None
+        if projected is None or basis.shape[0] != self.matrix.shape[1]: return None, None
+        return basis, projected[:len(self.matrix)]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def vector(self, path):
+        row = self.rows.get(path)
+        return None if row is None else self.matrix[row].astype(np.float32)
+
+    def query(self, vector, k=20, exclude=()):
+        """The k (path, cosine similarity) pairs closest to vector, best first"""
+        query = normalize(vector)
+        excluded = [self.rows[path] for path in exclude if path in self.rows]
+        if self.projected is not None and k + len(excluded) < CANDIDATES:
+            covered = len(self.projected)
+            approximate = self.projected @ (query @ self.basis)
+            approximate[self.deleted[:covered]] = -np.inf
+            candidates = np.concatenate([top_rows(approximate, CANDIDATES), np.arange(covered, len(self.matrix))])
+            candidates.sort()  # Sequential reads from the memory map
+        else:
+            candidates = np.arange(len(self.matrix))
+
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for i in range(0, len(candidates), CHUNK_ROWS):
+            rows = candidates[i:i + CHUNK_ROWS]
+            block = self.matrix[rows[0]:rows[-1] + 1] if rows[-1] - rows[0] + 1 == len(rows) else self.matrix[rows]
+            scores[i:i + CHUNK_ROWS] = block.astype(np.float32) @ query
+        scores[self.deleted[candidates]] = -np.inf
+        scores[np.isin(candidates, excluded)] = -np.inf
+        best = [i for i in top_rows(scores, k) if scores[i] > -np.inf]
+        return [(self.paths[candidates[i]], float(scores[i])) for i in best]
+
+def build_projection(directory, updated=(), seed=0):
+    """Project the rows added since the last call and those of the updated paths (every row when the
+    basis is refit); False when the library is too small"""
+    index = EmbeddingIndex(directory)
+    basis_file = os.path.join(directory, "projection.npz")
+    previous = [name for name in os.listdir(directory) if name.startswith("projected-")]
+    live = np.flatnonzero(~index.deleted)
+    if len(live) < PROJECTED_MIN_ROWS:
+        for name in previous + ["projection.npz"] * os.path.exists(basis_file):
+            os.remove(os.path.join(directory, name))
+        return False
+
+    basis, fitted_rows = index.basis, 0
+    if basis is not None:
+        with np.load(basis_file) as saved:
+            fitted_rows, generation = int(saved["fitted_rows"]), int(saved["generation"])
+    if basis is not None and len(live) < fitted_rows * REFIT_GROWTH:
+        # Same basis: project the rows of modified files again, append the new ones. Readers
+        # only use the projection to pick candidates, so a row changing under them is harmless
+        covered = len(index.projected)
+        row_bytes = basis.shape[1] * 4
+        with open(os.path.join(directory, f"projected-{generation}.f32"), 'r+b') as f:
+            for row in sorted(index.rows[path] for path in updated if index.rows.get(path, covered) < covered):
+                f.seek(row * row_bytes)
+                f.write(project_rows(index.matrix[row:row + 1], basis).tobytes())
+            f.truncate(covered * row_bytes)  # A torn row of an interrupted append
+            f.seek(covered * row_bytes)
+            f.write(project_rows(index.matrix[covered:], basis).tobytes())
+        return True
+
+    # Uncentred PCA: the directions that best preserve dot products between rows
+    sample = np.sort(np.random.default_rng(seed).choice(live, min(PCA_SAMPLE, len(live)), replace=False))
+    rows = index.matrix[sample].astype(np.float32)
+    _, eigenvectors = np.linalg.eigh(rows.T @ rows)
+    basis = np.ascontiguousarray(eigenvectors[:, ::-1][:, :PROJECTED_DIM])
+
+    # The basis file names its projected rows, so readers never pair a basis with rows from another one
+    generation = max([int(name[len("projected-"):].split(".")[0]) for name in previous] + [0]) + 1
+    projected_file = os.path.join(directory, f"projected-{generation}.f32")
+    project_rows(index.matrix, basis).tofile(projected_file)
+    np.savez(basis_file + ".tmp.npz", basis=basis, fitted_rows=len(live), generation=generation)
+    os.replace(basis_file + ".tmp.npz", basis_file)
+    for name in previous:
+        if name != os.path.basename(projected_file): os.remove(os.path.join(directory, name))
+    return True
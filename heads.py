@@ -0,0 +1,52 @@
+import os
+import json
+from tag_rules import TagRules
+
+# Extra classifier heads (danceability, genre, instruments...) run on the same
+# discogs-effnet embedding as the mood classifier. The embedding is the
+# expensive part of a track; a head is one small dense model over it, so any
+# number of them costs little more than the mood tags alone. Each head has its
+# own tag rules and writes its tags to its own field (see tagger.HEADS).
+
+def classifier_io(meta):
+    """(input, output) node names of a classifier from the schema of its metadata JSON"""
+    schema = meta.get("schema", {})
+    inputs, outputs = schema.get("inputs", []), schema.get("outputs", [])
+    if not inputs or not outputs: return "model/Placeholder", "model/Sigmoid"  # TensorflowPredict2D defaults
+    output = next((o for o in outputs if o.get("output_purpose") == "predictions"), outputs[0])
+    return inputs[0]["name"], output["name"]
+
+def check_embedding(meta, embedding_model_file, embedding_dim):
+    # A head only makes sense on the embedding it was trained on
+    expected = meta.get("inference", {}).get("embedding_model", {}).get("model_name")
+    if expected and expected != os.path.splitext(os.path.basename(embedding_model_file))[0]:
+        raise ValueError(f"{meta.get('name', 'head')} needs the {expected} embedding model, "
+                         f"not {os.path.basename(embedding_model_file)}")
+    shape = meta.get("schema", {}).get("inputs", [{}])[0].get("shape")
+    if shape and shape[-1] != embedding_dim:
+        raise ValueError(f"{meta.get('name', 'head')} expects {shape[-1]}-dimensional embeddings, not {embedding_dim}")
+
+class Head:
+    """A classifier run on the shared embedding, with its own tag rules and target field"""
+
+    def __init__(self, name, config, embedding_model_file, embedding_dim):
+        self.name = name
+        self.model_file, self.meta_file = config["model"], config["meta"]
+        if not os.path.exists(self.model_file): raise FileNotFoundError(f"Model of head {name} not found: {self.model_file}")
+        with open(self.meta_file, 'r') as f:
+            meta = json.load(f)
+        check_embedding(meta, embedding_model_file, embedding_dim)
+        self.classes = meta["classes"]
+        self.input, self.output = classifier_io(meta)
+        self.field = config.get("field", name)
+        self.prefix = config.get("prefix", "")  # Tags of this head in its field; "" owns the whole field
+
+        # Without a tag mapping, every class is a tag of its own (prefixed) name
+        threshold = config.get("threshold", 0.5)
+        tag_config = config.get("tags") or {raw_tag: (self.prefix + raw_tag, threshold) for raw_tag in self.classes}
+        self.rules = TagRules(self.classes, tag_config, set(config.get("ignored", ())), config.get("fallback_overrides", {}),
+                              config.get("fallback_threshold", float("inf")), config.get("max_tags", 1))
+
+    def decide(self, predictions):
+        """(tags, debug output) for each row of an N x classes prediction matrix"""
+        return self.rules.decide(predictions)
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+
+# Append-only log of the files finished in the current run. Entries reach the
+# OS as soon as they are written and are fsynced in batches, so `--resume` can
+# skip everything recorded before the run was killed (or, after a power loss,
+# everything up to the last synced batch).
+
+class Journal:
+    """JSON lines: a header with the run's config version, then one line per finished file"""
+
+    def __init__(self, path, config_version, sync_every=50, sync_seconds=5.0):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.config_version = config_version
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.file = None
+        self.before_sync = None  # Called before every fsync, e.g. to flush stores the entries refer to
+        self._valid_end = 0  # Bytes of the existing journal up to its last complete entry
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def read(self):
+        """Entries of an existing journal written under the same config version, by path"""
+        entries = {}
+        self._valid_end = 0
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline() or b"{}")
+                if header.get("config") != self.config_version: return {}
+                self._valid_end = f.tell()
+                for line in f:
+                    if not line.endswith(b"\n"): break  # Torn last line of an interrupted write
+                    try: entry = json.loads(line)
+                    except ValueError: break
+                    entries[entry["path"]] = entry
+                    self._valid_end = f.tell()
+        except (OSError, ValueError):
+            return {}
+        return entries
+
+    def open(self, resume=False):
+        """Start the journal; with resume, keep the entries of the interrupted run and return them"""
+        completed = self.read() if resume else {}
+        if completed:
+            # Appending after a torn line would glue the next entry to it, and hide every later one
+            os.truncate(self.path, self._valid_end)
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'w')
+            self.file.write(json.dumps({"config": self.config_version, "started": time.time()}) + "\n")
+            self.sync()
+        return completed
+
+    def record(self, path, status, tags=(), write=None, **fields):
+        """Mark a file as finished (call after its tags were written); fields are stored with the entry"""
+        entry = {"path": path, "status": status, "tags": list(tags), "write": write}
+        entry.update(fields)
+        self.file.write(json.dumps(entry) + "\n")
+        # Flushed right away so a killed process loses nothing; fsync (power loss) is batched
+        self.file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        if self.before_sync is not None:
+            self.before_sync()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self, finished=False):
+        # A finished run leaves nothing to resume
+        self.sync()
+        self.file.close()
+        if finished:
+            os.remove(self.path)
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+
+# Index of every file the tagger has processed, so reruns only touch files
+# that are new, modified, or were tagged under a different configuration.
+
+class Manifest:
+    """SQLite table of path, size, mtime, inode and config version per processed file"""
+
+    COMMIT_EVERY = 200
+
+    def __init__(self, db_path, config_version):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.config_version = config_version
+        self._pending = 0
+        self.before_commit = None  # Called before every commit, e.g. to flush data a recorded file must have
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, config TEXT)"
+        )
+        self.db.commit()
+
+    def begin_scan(self):
+        """Load the manifest so files can be classified one by one as they are discovered"""
+        self._known = {row[0]: row[1:] for row in self.db.execute("SELECT path, size, mtime_ns, inode, config FROM files")}
+
+    def classify(self, path):
+        """new, changed, reconfigured or unchanged (call between begin_scan and end_scan)"""
+        return self._compare(path, self._known.pop(path, None))
+
+    def status(self, path):
+        """new, changed, reconfigured or unchanged for a single file, outside of a scan"""
+        entry = self.db.execute("SELECT size, mtime_ns, inode, config FROM files WHERE path = ?", (path,)).fetchone()
+        return self._compare(path, entry)
+
+    def _compare(self, path, entry):
+        if entry is None: return "new"
+        try: st = os.stat(path)
+        except OSError: return "new"
+        size, mtime_ns, inode, config = entry
+        if (st.st_size, st.st_mtime_ns, st.st_ino) != (size, mtime_ns, inode):
+            return "changed"
+        if config != self.config_version:
+            return "reconfigured"
+        return "unchanged"
+
+    def end_scan(self):
+        """Paths in the manifest that were not seen during the scan and no longer exist"""
+        # Files skipped by include/exclude filters are not seen either, but still exist
+        deleted = [path for path in self._known if not os.path.exists(path)]
+        self._known = {}
+        return deleted
+
+    def record(self, path):
+        """Mark a file as processed with its current stat (call after writing its tags)"""
+        try: st = os.stat(path)
+        except OSError: return
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, st.st_ino, self.config_version)
+        )
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self.commit()
+
+    def forget(self, paths):
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+        self.db.commit()
+
+    def commit(self):
+        if self.before_commit is not None: self.before_commit()
+        self.db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
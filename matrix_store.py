@@ -0,0 +1,124 @@
+import os
+import json
+import numpy as np
+
+# Row-per-track matrix on disk (raw memory-mapped file) with a JSON path index.
+# Used for the raw class probabilities of every track, so thresholds can be
+# re-evaluated over the whole library without decoding any audio. Flushes only
+# append the rows added or removed since to a JSON lines log; the index is
+# rewritten with the log folded in on open and close, or once the log outgrows it.
+
+class MatrixStore:
+    """Memory-mapped N x dim matrix keyed by file path"""
+
+    GROW_ROWS = 4096
+
+    def __init__(self, directory, dim, dtype=np.float32, columns=None):
+        self.directory = directory
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.columns = list(columns) if columns is not None else None
+        self.data_file = os.path.join(directory, "matrix.bin")
+        self.index_file = os.path.join(directory, "index.json")
+        self.log_file = os.path.join(directory, "paths.log")
+        os.makedirs(directory, exist_ok=True)
+
+        self.paths = []
+        meta = self._read_index(directory)
+        # Start over when the shape or the columns changed (e.g. another model)
+        if meta and (meta["dim"], meta["dtype"], meta.get("columns")) == (dim, self.dtype.str, self.columns):
+            self.paths = meta["paths"]
+        elif os.path.exists(self.data_file):
+            os.remove(self.data_file)
+        self.rows = {path: row for row, path in enumerate(self.paths) if path is not None}
+        self._pending = []  # (row, path or None) changes not logged yet
+        self._logged = 0
+        self._map(max(len(self.paths), self.GROW_ROWS))
+        self._compact()
+
+    @staticmethod
+    def _read_index(directory):
+        try:
+            with open(os.path.join(directory, "index.json"), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Replaying the log is idempotent, so entries already folded into the index do no harm
+        paths = meta["paths"]
+        try:
+            with open(os.path.join(directory, "paths.log"), 'r') as f:
+                for line in f:
+                    if not line.endswith("\n"): break  # Torn last line of an interrupted flush
+                    row, path = json.loads(line)
+                    paths.extend([None] * (row + 1 - len(paths)))
+                    paths[row] = path
+        except OSError:
+            pass
+        return meta
+
+    def _map(self, capacity):
+        # Grow the backing file and map it again
+        size = capacity * self.dim * self.dtype.itemsize
+        with open(self.data_file, 'ab') as f:
+            if f.tell() < size: f.truncate(size)
+        self.capacity = capacity
+        self.matrix = np.memmap(self.data_file, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+
+    def put(self, path, vector):
+        row = self.rows.get(path)
+        if row is None:
+            row = len(self.paths)
+            if row >= self.capacity:
+                self.matrix.flush()
+                self._map(self.capacity * 2)
+            self.paths.append(path)
+            self.rows[path] = row
+            self._pending.append((row, path))
+        self.matrix[row] = vector
+
+    def remove(self, paths):
+        # Rows of removed paths are left unused rather than compacted
+        for path in paths:
+            row = self.rows.pop(path, None)
+            if row is not None:
+                self.paths[row] = None
+                self._pending.append((row, None))
+
+    def flush(self):
+        # The rows reach the matrix file before the log names them
+        self.matrix.flush()
+        if not self._pending: return
+        if self._logged + len(self._pending) > len(self.paths):
+            self._compact()  # Keeps the bytes written linear in the number of rows
+            return
+        with open(self.log_file, 'a') as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in self._pending))
+        self._logged += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.matrix.flush()
+        self._compact()
+
+    def _compact(self):
+        # Rewrite the index with every path, then drop the log it now contains
+        meta = {"dim": self.dim, "dtype": self.dtype.str, "columns": self.columns, "paths": self.paths}
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self.index_file)
+        if os.path.exists(self.log_file): os.remove(self.log_file)
+        self._logged = 0
+        self._pending = []
+
+def load_matrix(directory):
+    """Read-only view of a stored matrix: (paths, matrix, columns), None if missing"""
+    meta = MatrixStore._read_index(directory)
+    if meta is None: return None
+    paths = meta["paths"]
+    matrix = np.memmap(os.path.join(directory, "matrix.bin"), dtype=np.dtype(meta["dtype"]), mode='r')
+    matrix = matrix[:len(paths) * meta["dim"]].reshape(-1, meta["dim"])
+    if None in paths:
+        rows = [row for row, path in enumerate(paths) if path is not None]
+        paths, matrix = [paths[row] for row in rows], matrix[rows]
+    return paths, matrix, meta.get("columns")
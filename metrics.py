@@ -0,0 +1,107 @@
+import csv
+import json
+import time
+import random
+import contextlib
+import numpy as np
+
+# Optional per-file stage timings (probe, decode, fingerprint, embedding, classifier, save)
+# and run counters, summarised into percentiles and histograms at the end of a
+# run. Timings travel with each result dict, so they work the same across the
+# pipeline threads and the worker processes.
+
+STAGES = ("probe", "decode", "fingerprint", "embedding", "classifier", "save")
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+MAX_SAMPLES = 10000  # Timings kept per stage for the percentiles (a uniform sample beyond that)
+
+@contextlib.contextmanager
+def stage(timings, name):
+    """Add the wall time of the block to timings[name] (no-op when timings is None)"""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try: yield
+    finally: timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def add_timings(*timings):
+    """Sum stage timings dicts (None entries are skipped)"""
+    total = {}
+    for entry in timings:
+        for name, seconds in (entry or {}).items():
+            total[name] = total.get(name, 0.0) + seconds
+    return total
+
+def histogram(counts):
+    """Labelled counts per bucket of HISTOGRAM_BOUNDS_MS ("<=1ms", "<=2ms", ..., ">10000ms")"""
+    labels = [f"<={bound}ms" for bound in HISTOGRAM_BOUNDS_MS] + [f">{HISTOGRAM_BOUNDS_MS[-1]}ms"]
+    return {label: int(count) for label, count in zip(labels, counts)}
+
+class Metrics:
+    """Stage timings and counters of one run, written as JSON (summary) or CSV (one row per file)"""
+
+    def __init__(self, path=None):
+        self.path = path
+        # Stage -> exact count, total, max and histogram, plus a bounded sample of seconds per file,
+        # so a long watch or service run keeps constant memory
+        self.stages = {}
+        self._random = random.Random(0)
+        self.counters = {}
+        self.started = time.monotonic()
+        self._csv_file = self._rows = None
+        if path and path.lower().endswith(".csv"):
+            self._csv_file = open(path, 'w', newline='')
+            self._rows = csv.writer(self._csv_file)
+            self._rows.writerow(["path", "status"] + [f"{name}_ms" for name in STAGES] + ["total_ms"])
+
+    # Called from the single writer thread only, so no locking is needed
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, path, status, timings):
+        total = sum(timings.values())
+        for name, seconds in list(timings.items()) + [("total", total)]:
+            self._add(name, seconds)
+        if self._rows is not None:
+            self._rows.writerow([path, status] + [f"{timings[name]*1000:.1f}" if name in timings else ""
+                                                  for name in STAGES] + [f"{total*1000:.1f}"])
+
+    def _add(self, name, seconds):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(HISTOGRAM_BOUNDS_MS) + 1), "samples": []}
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["buckets"][int(np.searchsorted(HISTOGRAM_BOUNDS_MS, seconds * 1000))] += 1
+        # Reservoir sampling: every timing so far is in the sample with the same probability
+        if len(stats["samples"]) < MAX_SAMPLES:
+            stats["samples"].append(seconds)
+        else:
+            slot = self._random.randrange(stats["count"])
+            if slot < MAX_SAMPLES: stats["samples"][slot] = seconds
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        files = self.stages["total"]["count"] if "total" in self.stages else 0
+        stages = {}
+        for name in [s for s in STAGES if s in self.stages] + [s for s in self.stages if s not in STAGES]:
+            stats = self.stages[name]
+            p50, p90, p99 = np.percentile(np.array(stats["samples"]) * 1000, [50, 90, 99])
+            stages[name] = {
+                "count": stats["count"], "total_s": round(stats["total"], 3), "mean_ms": round(stats["total"] / stats["count"] * 1000, 2),
+                "p50_ms": round(p50, 2), "p90_ms": round(p90, 2), "p99_ms": round(p99, 2), "max_ms": round(stats["max"] * 1000, 2),
+                "histogram": histogram(stats["buckets"]),
+            }
+        return {"elapsed_s": round(elapsed, 3), "files": files, "files_per_s": round(files / elapsed, 3) if elapsed > 0 else 0.0,
+                "counters": dict(sorted(self.counters.items())), "stages": stages}
+
+    def close(self):
+        """Write the metrics file and return the summary"""
+        summary = self.summary()
+        if self._csv_file is not None:
+            self._csv_file.close()
+        elif self.path:
+            with open(self.path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
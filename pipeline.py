@@ -0,0 +1,76 @@
+import time
+import queue
+import threading
+
+# Staged producer/consumer pipeline: a pool of decoder threads feeds decoded
+# chunks into a single inference stage, which feeds a single tag writer.
+# The queues between stages are bounded, so a slow stage blocks the stages
+# before it instead of letting decoded audio pile up in memory. The inference
+# stage can group several tracks into one batch, waiting at most batch_wait
+# seconds for a batch to fill up.
+
+_DONE = object()
+
+def run_pipeline(paths, decode, infer, write, decode_workers=4, decode_queue_size=8, write_queue_size=32,
+                 batch_size=1, batch_wait=2.0):
+    """Run decode(path) -> infer([(path, audio), ...]) -> write(result) over all paths.
+
+    decode runs on decode_workers threads, infer on the calling thread (so the
+    models stay on one warm thread) and write on a dedicated writer thread.
+    """
+    paths = iter(paths)
+    paths_lock = threading.Lock()
+    decoded = queue.Queue(maxsize=decode_queue_size)
+    results = queue.Queue(maxsize=write_queue_size)
+    write_errors = []
+
+    def decoder():
+        try:
+            while True:
+                with paths_lock:
+                    path = next(paths, None)
+                if path is None: break
+                try: audio = decode(path)
+                except Exception: audio = None
+                decoded.put((path, audio))
+        finally:
+            decoded.put(_DONE)
+
+    def writer():
+        while True:
+            result = results.get()
+            if result is _DONE: break
+            try: write(result)
+            except Exception as e:
+                # Keep draining so the inference stage never blocks on a dead writer
+                write_errors.append(e)
+
+    # Named threads show up as such in py-spy dumps and flame graphs
+    decoders = [threading.Thread(target=decoder, name=f"decoder-{n}", daemon=True) for n in range(max(1, decode_workers))]
+    writer_thread = threading.Thread(target=writer, name="writer", daemon=True)
+    for thread in decoders: thread.start()
+    writer_thread.start()
+
+    finished = 0
+    while finished < len(decoders):
+        batch = []
+        deadline = None
+        while finished < len(decoders) and len(batch) < batch_size:
+            try:
+                if deadline is None: item = decoded.get()
+                else: item = decoded.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                finished += 1
+                continue
+            batch.append(item)
+            if deadline is None: deadline = time.monotonic() + batch_wait
+        if not batch: continue
+        for result in infer(batch):
+            results.put(result)
+
+    results.put(_DONE)
+    writer_thread.join()
+    if write_errors:
+        raise write_errors[0]
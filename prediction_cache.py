@@ -0,0 +1,95 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+# Persistent cache of averaged effnet embeddings and raw mood predictions.
+# Entries are keyed by a hash of the decoded audio chunk, so rewriting the
+# tags of a file (which changes its bytes but not its audio) keeps it cached.
+# The whole cache is dropped when any of the model files change.
+
+def fingerprint_files(paths):
+    """Hash the contents of the given files (model graphs, metadata)"""
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def audio_key(audio):
+    """Content hash of a decoded float32 audio chunk"""
+    return hashlib.blake2b(np.ascontiguousarray(audio, dtype=np.float32).tobytes(), digest_size=20).hexdigest()
+
+class PredictionCache:
+    """SQLite store of (embedding, predictions) with size-bounded LRU eviction"""
+
+    EVICT_EVERY = 100  # Check the size bound every N inserts
+
+    def __init__(self, db_path, model_files, max_mb=1024):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.invalidated = False
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, embedding BLOB, predictions BLOB, size INTEGER, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+        # Invalidate everything when the models changed since the cache was written
+        models = fingerprint_files(model_files)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'models'").fetchone()
+        if row is None or row[0] != models:
+            self.invalidated = row is not None
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('models', ?)", (models,))
+        self.db.commit()
+        self._evict()
+
+    def get(self, key):
+        """Return (embedding, predictions) for a cached chunk, or None"""
+        with self._lock:
+            row = self.db.execute("SELECT embedding, predictions FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return np.frombuffer(row[0], dtype=np.float32), np.frombuffer(row[1], dtype=np.float32)
+
+    def put(self, key, embedding, predictions):
+        embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+        predictions = np.asarray(predictions, dtype=np.float32).tobytes()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, embedding, predictions, len(embedding) + len(predictions), time.time())
+            )
+            self.db.commit()
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its bound
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes: return
+        target = self.max_bytes * 0.9
+        victims = []
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if total <= target: break
+            victims.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM entries WHERE key = ?", victims)
+        self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+# Work order and budget for runs that must fit a maintenance window. Files are
+# ordered by priority (never tagged, then modified since they were tagged, then
+# tagged under an older config; newest first within each) and packed into the
+# time budget with a per-format cost model: fixed seconds per file plus seconds
+# per second of audio, with the duration estimated from the file size. The
+# model is refitted after every budgeted run from the measured stage timings,
+# and scaled by the measured ratio of wall time to work (parallel speedup).
+
+PRIORITIES = ("new", "changed", "reconfigured", "unchanged")
+BYTES_PER_SECOND = {"mp3": 24000, "flac": 100000, "m4a": 32000, "mp4": 32000}  # 192k mp3, CD flac, 256k AAC
+DEFAULT_BYTES_PER_SECOND = 32000
+DEFAULT_COST = (1.5, 0.0)  # (seconds per file, seconds per second of audio) until a format was measured
+LEARNING_RATE = 0.5  # Weight of the latest run when updating the cost model
+MIN_SAMPLES = 5  # Files of a format a run needs to refit that format's cost
+
+def parse_duration(value):
+    """'5400', '90m', '1.5h' or '45s' -> seconds"""
+    units = {"s": 1, "m": 60, "h": 3600}
+    value = value.strip().lower()
+    seconds = float(value[:-1]) * units[value[-1]] if value[-1:] in units else float(value)
+    if seconds < 0: raise ValueError(f"negative duration: {value}")
+    return seconds
+
+def format_of(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+def estimated_duration(path, size):
+    return size / BYTES_PER_SECOND.get(format_of(path), DEFAULT_BYTES_PER_SECOND)
+
+def blend(old, new):
+    return new if old is None else old + LEARNING_RATE * (new - old)
+
+class CostModel:
+    """Estimated wall seconds to process a file, learned from earlier runs"""
+
+    def __init__(self, path):
+        self.path = path
+        self.formats = {}  # Format -> [seconds per file, seconds per second of audio] of work
+        self.scale = 1.0  # Wall seconds per second of work (below 1 with parallel decoding or workers)
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            self.formats, self.scale = saved["formats"], saved["scale"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def estimate(self, path, size):
+        base, per_second = self.formats.get(format_of(path), DEFAULT_COST)
+        return self.scale * (base + per_second * estimated_duration(path, size))
+
+    def update(self, samples):
+        """Refit from the (path, size, work seconds, time written) of the files a run processed, in order"""
+        by_format = {}
+        for path, size, work, _ in samples:
+            by_format.setdefault(format_of(path), []).append((estimated_duration(path, size), work))
+        for name, points in by_format.items():
+            if len(points) < MIN_SAMPLES: continue
+            durations, work = np.array(points, dtype=np.float64).T
+            (base, per_second), *_ = np.linalg.lstsq(np.stack([np.ones_like(durations), durations], axis=1), work, rcond=None)
+            if base < 0 or per_second < 0:
+                base, per_second = work.mean(), 0.0  # Too little spread in length to fit a slope
+            old = self.formats.get(name)
+            self.formats[name] = [blend(old and old[0], float(base)), blend(old and old[1], float(per_second))]
+        if len(samples) > 1:
+            # Steady state, from the first file written to the last: model loading is not a per-file cost
+            wall = samples[-1][3] - samples[0][3]
+            work = sum(sample[2] for sample in samples[1:])
+            if wall > 0 and work > 0:
+                self.scale = blend(self.scale, wall / work)
+
+    def save(self):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({"formats": self.formats, "scale": self.scale}, f)
+        os.replace(tmp_file, self.path)
+
+def plan(candidates, costs, budget_seconds=None, max_files=None):
+    """Order (path, status, size, mtime) candidates and pack them into the budget: (planned, estimated seconds)"""
+    ordered = sorted(candidates, key=lambda c: (PRIORITIES.index(c[1]), -c[3]))
+    planned, total = [], 0.0
+    for candidate in ordered:
+        if max_files is not None and len(planned) >= max_files: break
+        cost = costs[candidate[0]]
+        # A file that does not fit is left for the next run; cheaper ones after it may still fit
+        if budget_seconds is not None and total + cost > budget_seconds: continue
+        planned.append(candidate)
+        total += cost
+    return planned, total
+
+class Budget:
+    """Admits files while the estimated cost of the files in flight still fits before the deadline"""
+
+    def __init__(self, seconds, started):
+        self.deadline = started + seconds if seconds is not None else None
+        self.in_flight = {}  # Path -> estimated cost, until its result is written
+        self.pending_cost = 0.0
+        self.lock = threading.Lock()  # Admitted by the decoder threads, finished by the writer
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def admit(self, path, cost):
+        with self.lock:
+            if self.deadline is not None and time.monotonic() + self.pending_cost + cost > self.deadline:
+                return False
+            self.in_flight[path] = cost
+            self.pending_cost += cost
+            return True
+
+    def finish(self, path):
+        with self.lock:
+            self.pending_cost -= self.in_flight.pop(path, 0.0)
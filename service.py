@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tagger
+from prediction_cache import PredictionCache
+
+# Local HTTP service keeping both models warm, for tools that want mood
+# predictions for a file or for raw PCM without running the whole tagger.
+# Audio is decoded on the request threads; one inference thread coalesces
+# whatever requests are waiting into a model batch.
+#
+#   POST /predict  {"path": "..."} or {"paths": [...]}, or a raw float32 body
+#                  (mono, 16 kHz, Content-Type: application/octet-stream)
+#   GET  /stats    latency, throughput and batching statistics
+#   GET  /health
+
+# --- CONFIGURATION ---
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+MAX_BATCH = 8  # Tracks per model call
+MAX_WAIT = 0.05  # Seconds a request may wait for others to join its batch
+STATS_WINDOW = 10000  # Recent requests the latency percentiles are computed over
+MAX_PCM_SECONDS = 600  # Largest raw audio body accepted
+
+class Request:
+    """One track waiting for the inference thread"""
+
+    def __init__(self, path, audio):
+        self.path = path
+        self.audio = audio
+        self.queued = time.monotonic()
+        self.result = None
+        self.done = threading.Event()
+
+class Batcher:
+    """Runs the models on one thread, batching requests that arrive within max_wait of each other"""
+
+    def __init__(self, classes, stats, max_batch=MAX_BATCH, max_wait=MAX_WAIT, heads=()):
+        self.classes = classes
+        self.heads = heads
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="inference", daemon=True)
+
+    def start(self):
+        # Returns once the models are loaded
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None: raise self.error
+
+    def submit(self, items):
+        """Analyse (path, audio) pairs; blocks until all their results are ready"""
+        requests = [Request(path, audio) for path, audio in items]
+        for request in requests: self.queue.put(request)
+        for request in requests: request.done.wait()
+        return [request.result for request in requests]
+
+    def _run(self):
+        try:
+            embedding_model, classifier_model = tagger.load_models()
+            heads = [(head, tagger.load_head_model(head)) for head in self.heads]
+            # Same parity gate as the tagger before the first batched embedding
+            batching = {"model": tagger.load_patch_model() if self.max_batch > 1 else None, "checked": False}
+            cache = None
+            if tagger.CACHE_ENABLED:
+                cache = PredictionCache(tagger.CACHE_FILE, [tagger.EMBEDDING_MODEL_FILE, tagger.CLASSIFIER_MODEL_FILE, tagger.META_FILE],
+                                        max_mb=tagger.CACHE_MAX_MB)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try: batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty: break
+
+            started = time.monotonic()
+            try:
+                items = [(r.path, r.audio) for r in batch]
+                patch_model = tagger.checked_patch_model(batching, items, embedding_model)
+                results = tagger.analyze_batch(items, embedding_model, classifier_model, self.classes, cache, patch_model, heads=heads)
+            except Exception as e:
+                results = [{"path": r.path, "status": "error", "tags": [], "debug": [], "error": str(e), "cached": False}
+                           for r in batch]
+            self.stats.batch(len(batch), time.monotonic() - started, [started - r.queued for r in batch])
+            for request, result in zip(batch, results):
+                request.result = result
+                request.audio = None
+                request.done.set()
+
+def percentiles(values):
+    if not values: return None
+    values = np.array(values) * 1000
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50_ms": round(p50, 2), "p90_ms": round(p90, 2), "p99_ms": round(p99, 2), "max_ms": round(values.max(), 2)}
+
+class ServiceStats:
+    """Counters since startup, percentiles over the last STATS_WINDOW requests and batches"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = self.tracks = self.errors = self.batches = 0
+        self.batch_sizes = {}
+        self.latency = deque(maxlen=window)
+        self.decode = deque(maxlen=window)
+        self.queue_wait = deque(maxlen=window)
+        self.inference = deque(maxlen=window)
+        self.finished = deque(maxlen=window)  # Completion times, for the recent throughput
+
+    def request(self, seconds, tracks, decode_seconds=None, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.latency.append(seconds)
+            if decode_seconds is not None: self.decode.append(decode_seconds)
+            now = time.monotonic()
+            for _ in range(tracks):
+                self.finished.append(now)
+            self.tracks += tracks
+
+    def batch(self, size, seconds, waits):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+            self.inference.append(seconds)
+            self.queue_wait.extend(waits)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.monotonic()
+            uptime = now - self.started
+            recent = sum(1 for t in self.finished if now - t <= 60)
+            return {
+                "uptime_s": round(uptime, 1), "requests": self.requests, "tracks": self.tracks, "errors": self.errors,
+                "tracks_per_s": round(self.tracks / uptime, 3) if uptime > 0 else 0.0,
+                "tracks_per_s_last_minute": round(recent / min(60.0, uptime), 3) if uptime > 0 else 0.0,
+                "batches": self.batches,
+                "mean_batch_size": round(sum(size * n for size, n in self.batch_sizes.items()) / self.batches, 2) if self.batches else 0.0,
+                "batch_sizes": {str(size): n for size, n in sorted(self.batch_sizes.items())},
+                "latency": percentiles(list(self.latency)), "decode": percentiles(list(self.decode)),
+                "queue_wait": percentiles(list(self.queue_wait)), "inference_per_batch": percentiles(list(self.inference)),
+            }
+
+def format_result(result, classes, heads=()):
+    response = {"path": result["path"], "status": result["status"], "tags": result["tags"], "debug": result["debug"],
+                "cached": result["cached"]}
+    if "predictions" in result:
+        response["scores"] = {raw_tag: round(float(score), 6) for raw_tag, score in zip(classes, result["predictions"])}
+    if "heads" in result:
+        response["heads"] = {head.name: {"tags": result["heads"][head.name]["tags"],
+                                         "scores": {raw_tag: round(float(score), 6) for raw_tag, score
+                                                    in zip(head.classes, result["heads"][head.name]["predictions"])}}
+                             for head in heads}
+    if result["error"]:
+        response["error"] = result["error"]
+    return response
+
+class Handler(BaseHTTPRequestHandler):
+    # server.batcher, server.stats, server.classes, server.decoder and server.heads are set in main()
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per request is too much at batch rates; see /stats
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "Not found"})
+            return
+        started = time.monotonic()
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_PCM_SECONDS * 16000 * 4:
+            self.send_json(413, {"error": f"Body larger than {MAX_PCM_SECONDS}s of audio"})
+            return
+        body = self.rfile.read(length)
+
+        if self.headers.get("Content-Type", "").startswith("application/octet-stream"):
+            if length % 4:
+                self.send_json(400, {"error": "Raw audio must be float32 samples"})
+                return
+            items = [(None, np.frombuffer(body, dtype=np.float32))]
+            decode_seconds = None
+        else:
+            try:
+                request = json.loads(body or b"{}")
+                paths = request["paths"] if "paths" in request else [request["path"]]
+                if not all(isinstance(path, str) for path in paths): raise ValueError
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {"error": 'Expected {"path": ...}, {"paths": [...]} or a raw float32 body'})
+                return
+            decode_started = time.monotonic()
+            items = [(path, tagger.read_middle_chunk(path, self.server.decoder) if os.path.isfile(path) else None)
+                     for path in paths]
+            decode_seconds = time.monotonic() - decode_started
+
+        results = self.server.batcher.submit(items)
+        errors = sum(result["status"] == "error" for result in results)
+        self.server.stats.request(time.monotonic() - started, len(results), decode_seconds, error=errors > 0)
+        self.send_json(200, {"results": [format_result(result, self.server.classes, self.server.heads) for result in results]})
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mood predictions over HTTP with the models kept loaded.")
+    parser.add_argument("--host", default=SERVICE_HOST, help="Address to listen on (use 0.0.0.0 inside a container)")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="Maximum tracks per model call")
+    parser.add_argument("--max-wait", type=float, default=MAX_WAIT, help="Seconds a request may wait for others to join its batch")
+    parser.add_argument("--decoder", choices=sorted(tagger.DECODERS), default=tagger.DECODER, help="Decoder for path requests")
+    args = parser.parse_args()
+
+    print("--- Music Mood Tagger Service ---")
+    with open(tagger.META_FILE, 'r') as f:
+        classes = json.load(f)['classes']
+
+    heads = tagger.load_heads()
+    print(f"Loading models ({', '.join(['discogs-effnet', 'mtg-jamendo-moodtheme'] + [head.name for head in heads])})...")
+    stats = ServiceStats()
+    batcher = Batcher(classes, stats, args.max_batch, args.max_wait, heads)
+    batcher.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.batcher, server.stats, server.classes, server.decoder = batcher, stats, classes, args.decoder
+    server.heads = heads
+    print(f"Listening on http://{args.host}:{args.port} (batches of up to {args.max_batch}, {args.max_wait*1000:.0f} ms wait)")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import glob
+import json
+import base64
+import hashlib
+import numpy as np
+from journal import Journal
+
+# Sharded runs across several hosts that mount the same library. Each node runs
+# `tagger.py --shard i/N`: it analyses only the files whose path (relative to
+# the music folder, so mount points may differ) hashes to shard i, and appends
+# their predictions, embedding and planned tags to its own JSON lines file.
+# Nodes write no tags, manifest, stores, cache or duplicate index. `tagger.py --apply-shards` then
+# merges the shard files and writes the tags, manifest and stores in one place.
+
+def parse_shard(value):
+    """'2/8' -> (2, 8); shards are numbered from 0"""
+    index, _, count = value.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count: raise ValueError(f"shard {index} out of range for {count} shards")
+    return index, count
+
+def relative_path(path, root):
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+def shard_of(path, root, count):
+    """Shard of a file, the same on every host: hash of its path relative to the music folder"""
+    digest = hashlib.sha1(relative_path(path, root).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def shard_file(directory, index, count):
+    return os.path.join(directory, f"shard-{index}-of-{count}.jsonl")
+
+def open_shard_output(path, config_version, classes, index, count, resume=False, sync_every=50):
+    """Results file of one shard (a journal that is kept); returns it with the entries of an interrupted run"""
+    output = Journal(path, {"config": config_version, "classes": classes, "shard": index, "shards": count}, sync_every)
+    return output, output.open(resume)
+
+def shard_entry(result):
+    """Fields of a result stored in a shard file, besides path, status and tags"""
+    fields = {"debug": result["debug"], "error": result["error"]}
+    try:
+        st = os.stat(result["path"])
+        fields["size"], fields["mtime"] = st.st_size, st.st_mtime
+    except OSError:
+        pass
+    if "predictions" in result:
+        fields["predictions"] = [float(score) for score in result["predictions"]]
+        embedding = np.asarray(result["embedding"], dtype=np.float16).tobytes()
+        fields["embedding"] = base64.b64encode(embedding).decode()
+    if "heads" in result:
+        fields["heads"] = {name: {"tags": decided["tags"], "debug": decided["debug"],
+                                  "predictions": [float(score) for score in decided["predictions"]]}
+                           for name, decided in result["heads"].items()}
+    return fields
+
+def read_shards(paths):
+    """Headers of the shard files in paths (files or directories) and their entries by relative path.
+
+    Files are read oldest first, so when a file appears in several shard files
+    (e.g. after re-sharding), the most recent analysis wins.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "shard-*.jsonl"))) if os.path.isdir(path) else [path])
+    headers, entries = [], {}
+    for file in sorted(files, key=os.path.getmtime):
+        with open(file, 'r') as f:
+            try: header = json.loads(f.readline() or "{}").get("config")
+            except ValueError: header = None
+            if not isinstance(header, dict) or "shard" not in header:
+                raise ValueError(f"{file} is not a shard results file")
+            header["file"] = file
+            headers.append(header)
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: break  # Torn last line of an interrupted shard
+                entries[entry["path"]] = (header, entry)
+    return headers, entries
+
+def missing_shards(headers):
+    """Shard count -> indices with no results file"""
+    present = {}
+    for header in headers:
+        present.setdefault(header["shards"], set()).add(header["shard"])
+    return {count: sorted(set(range(count)) - indices) for count, indices in sorted(present.items())}
+
+def unchanged_since_analysis(path, entry):
+    try: st = os.stat(path)
+    except OSError: return False
+    # Mount types differ in timestamp precision between hosts
+    return st.st_size == entry.get("size") and abs(st.st_mtime - entry.get("mtime", 0)) < 1.0
+
+def shard_result(path, entry):
+    """Result dict, as the analysis stages build it, from a shard file entry"""
+    result = {"path": path, "status": entry["status"], "tags": entry["tags"], "debug": entry["debug"],
+              "error": entry["error"], "cached": False}
+    if "predictions" in entry:
+        result["predictions"] = np.array(entry["predictions"], dtype=np.float32)
+        result["embedding"] = np.frombuffer(base64.b64decode(entry["embedding"]), dtype=np.float16).astype(np.float32)
+    if "heads" in entry:
+        result["heads"] = {name: dict(decided, predictions=np.array(decided["predictions"], dtype=np.float32))
+                           for name, decided in entry["heads"].items()}
+    return result
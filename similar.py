@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import tagger
+from embedding_index import EmbeddingIndex
+
+# "More like this": the tracks whose stored embeddings are closest (cosine
+# similarity) to those of one or more seed tracks, e.g. to build a mood radio.
+# Only tracks already analysed by tagger.py can be seeds or results; no model
+# is run.
+
+# --- CONFIGURATION ---
+RESULTS = 20
+
+def resolve(index, path):
+    # Stored paths are the ones found under the music folder
+    for candidate in (path, os.path.abspath(path), os.path.realpath(path)):
+        if candidate in index.rows: return candidate
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the tracks that sound most like the given ones.")
+    parser.add_argument("paths", nargs="+", metavar="FILE", help="Seed tracks, already analysed by tagger.py (several seeds are averaged)")
+    parser.add_argument("-k", type=int, default=RESULTS, help="Number of tracks to return")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--embeddings", default=tagger.EMBEDDINGS_DIR, help="Directory of the embeddings stored by tagger.py")
+    args = parser.parse_args()
+
+    try: index = EmbeddingIndex(args.embeddings)
+    except FileNotFoundError:
+        print(f"Error: No stored embeddings in {args.embeddings}, run tagger.py first.")
+        sys.exit(1)
+    seeds = []
+    for path in args.paths:
+        stored = resolve(index, path)
+        if stored is None:
+            print(f"Error: {path} has not been analysed yet, run tagger.py first.")
+            sys.exit(1)
+        seeds.append(stored)
+
+    started = time.perf_counter()
+    results = index.query(np.mean([index.vector(path) for path in seeds], axis=0), args.k, exclude=seeds)
+    elapsed = time.perf_counter() - started
+
+    if args.json:
+        print(json.dumps({"seeds": seeds, "results": [{"path": path, "similarity": round(similarity, 4)}
+                                                      for path, similarity in results]}))
+        return
+    print(f"Most similar to {', '.join(os.path.basename(path) for path in seeds)} "
+          f"({len(index)} tracks searched in {elapsed*1000:.1f} ms):")
+    for path, similarity in results:
+        print(f"   {similarity:.3f}  {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+
+# TAG_CONFIG, IGNORED_TAGS and FALLBACK_OVERRIDES compiled once into arrays
+# indexed by model class, so the tag decision for a whole N x C prediction
+# matrix runs as array operations instead of a Python loop per class.
+
+class TagRules:
+    """Vectorized tag decision: thresholds, merging, MAX_TAGS cap and fallback pass"""
+
+    def __init__(self, classes, tag_config, ignored_tags, fallback_overrides, fallback_threshold, max_tags):
+        self.classes = list(classes)
+        self.max_tags = max_tags
+        self.display_tags = sorted(set(display_tag for display_tag, _ in tag_config.values()))
+        display_index = {tag: i for i, tag in enumerate(self.display_tags)}
+
+        count = len(self.classes)
+        self.mapped = np.zeros(count, dtype=bool)  # In the config and not ignored
+        self.output_index = np.zeros(count, dtype=np.int64)
+        self.thresholds = np.full(count, np.inf)
+        self.fallback_thresholds = np.full(count, np.inf)
+        for i, raw_tag in enumerate(self.classes):
+            if raw_tag in ignored_tags or raw_tag not in tag_config: continue
+            display_tag, threshold = tag_config[raw_tag]
+            self.mapped[i] = True
+            self.output_index[i] = display_index[display_tag]
+            self.thresholds[i] = threshold
+            self.fallback_thresholds[i] = max(fallback_threshold, fallback_overrides.get(raw_tag, fallback_threshold))
+
+    def decide(self, predictions):
+        """Return (final_tags, debug_output) for each row of an N x C prediction matrix"""
+        scores = np.atleast_2d(np.asarray(predictions))
+        rows, count = scores.shape
+        if rows == 0 or self.max_tags <= 0: return [([], []) for _ in range(rows)]
+
+        # Compare in the same precision as a numpy scalar against a Python float
+        compare = np.asarray(scores.dtype.type(0) * 1.0).dtype
+        order = np.argsort(scores, axis=1)[:, ::-1]
+        sorted_scores = np.take_along_axis(scores, order, axis=1)
+        compared = sorted_scores.astype(compare)
+        mapped = self.mapped[order]
+        outputs = self.output_index[order]
+
+        # First pass: earliest (highest scoring) passing position of each output tag,
+        # then the output tags in that order, capped at max_tags
+        passing = mapped & (compared >= self.thresholds.astype(compare)[order])
+        positions = np.where(passing, np.arange(count), count)
+        first = np.full((rows, len(self.display_tags)), count)
+        np.minimum.at(first, (np.repeat(np.arange(rows), count), outputs.ravel()), positions.ravel())
+        selected = np.sort(first, axis=1)[:, :self.max_tags]
+
+        # Second pass: best mapped tag above its fallback threshold
+        fallback_ok = mapped & (compared >= self.fallback_thresholds.astype(compare)[order])
+        fallback = np.where(fallback_ok.any(axis=1), fallback_ok.argmax(axis=1), -1)
+
+        decisions = []
+        for n in range(rows):
+            final_tags, debug_output = [], []
+            for position in selected[n]:
+                if position >= count: break
+                final_tags.append(self.display_tags[outputs[n, position]])
+                debug_output.append(f"{self.classes[order[n, position]]} ({sorted_scores[n, position]*100:.1f}%)")
+            if not final_tags and fallback[n] >= 0:
+                position = fallback[n]
+                final_tags.append(self.display_tags[outputs[n, position]])
+                debug_output.append(f"{self.classes[order[n, position]]} ({sorted_scores[n, position]*100:.1f}%)*")
+            decisions.append((final_tags, debug_output))
+        return decisions
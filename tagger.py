@@ -1,18 +1,52 @@
+import time
+_process_started = time.perf_counter()  # Start of the startup breakdown
 import os
 import json
+import signal
+import threading
+import shutil
+import tempfile
+import cProfile
+import hashlib
+import importlib.util
+import argparse
+import itertools
+import collections
+import multiprocessing
 import numpy as np
 import subprocess
 import mutagen
-from mutagen.id3 import ID3, TIT1, ID3NoHeaderError
+from mutagen.id3 import ID3, ID3NoHeaderError
 from mutagen.flac import FLAC
-from mutagen.mp4 import MP4
-from essentia.standard import TensorflowPredictEffnetDiscogs, TensorflowPredict2D
+from mutagen.id3 import Frames, TXXX
+from mutagen.mp4 import MP4, MP4FreeForm
+from prediction_cache import PredictionCache, audio_key
+from manifest import Manifest
+from pipeline import run_pipeline
+from tag_rules import TagRules
+from heads import Head, classifier_io
+from matrix_store import MatrixStore
+from discovery import AUDIO_EXTENSIONS, iter_audio_files, matches_filters, parse_extensions, Progress, format_duration
+from metrics import Metrics, stage, add_timings
+from journal import Journal
+from watcher import Debouncer, open_watcher
+from duplicates import DuplicateIndex, audio_fingerprint
+from embedding_index import build_projection, normalize
+from scheduler import Budget, CostModel, parse_duration, plan, PRIORITIES
+from shards import (parse_shard, shard_of, shard_file, open_shard_output, shard_entry, relative_path,
+                    read_shards, missing_shards, unchanged_since_analysis, shard_result)
+
+# essentia (and TensorFlow with it) is imported where it is used, at the first
+# model load: the import alone takes seconds, which runs with nothing to
+# analyse never pay. PyAV (optional, for --decoder av) is imported on first use too
+_startup = {"imports": time.perf_counter() - _process_started}  # Seconds per startup phase
 
 # --- CONFIGURATION ---
 MUSIC_FOLDER = "/music"
 EMBEDDING_MODEL_FILE = "/app/discogs-effnet-bs64-1.pb"
 CLASSIFIER_MODEL_FILE = "/app/mtg_jamendo_moodtheme-discogs-effnet-1.pb"
 META_FILE = "/app/mtg_jamendo_moodtheme-discogs-effnet-1.json"
+STATE_DIR = "/app/.tagger"  # Caches and indexes kept between runs
 
 # Settings
 FALLBACK_THRESHOLD = 0.06  # Minimum for fallback (base threshold)
@@ -25,6 +59,73 @@ FALLBACK_OVERRIDES = {
     "inspiring": 0.08, "hopeful": 0.08, "motivational": 0.10,
 }
 CHUNK_DURATION = 30
+DECODER = "ffmpeg"  # ffmpeg (ffprobe + ffmpeg subprocesses), essentia or av (in-process)
+
+# Prediction cache (skips inference for audio that was already analysed)
+CACHE_ENABLED = True
+CACHE_FILE = os.path.join(STATE_DIR, "prediction_cache.sqlite")
+CACHE_MAX_MB = 1024
+
+# Acoustic fingerprints (copies of a recording in other files or formats reuse its predictions)
+DUPLICATES_ENABLED = True
+DUPLICATES_FILE = os.path.join(STATE_DIR, "duplicates.sqlite")
+
+# Manifest of processed files (reruns skip files that are unchanged)
+MANIFEST_FILE = os.path.join(STATE_DIR, "manifest.sqlite")
+PROGRESS_INTERVAL = 10  # Seconds between progress lines
+
+# Raw class probabilities of every track (read by comprehensive_analysis.py --what-if)
+SCORES_DIR = os.path.join(STATE_DIR, "scores")  # Flushed before every manifest commit
+
+# Normalised track embeddings, float16 (searched by similar.py for "more like this")
+EMBEDDINGS_DIR = os.path.join(STATE_DIR, "embeddings")
+EMBEDDING_DIM = 1280  # discogs-effnet
+
+# Journal of the files finished in the current run (resumed with --resume after a crash)
+JOURNAL_FILE = os.path.join(STATE_DIR, "journal.jsonl")
+
+# Per-format processing cost learned by runs with --time-budget or --max-files
+COST_MODEL_FILE = os.path.join(STATE_DIR, "cost_model.json")
+
+# Results of --shard runs, merged and written by --apply-shards
+SHARDS_DIR = os.path.join(STATE_DIR, "shards")
+JOURNAL_SYNC_EVERY = 50  # Entries between fsyncs (also synced at least every 5 seconds)
+
+# Tag writing
+WRITE_PADDING = 4096  # Padding reserved when a tag block has to grow, so later writes fit in place
+
+# Pipeline (decoding, inference and tag writing overlap; 0 decode workers = sequential)
+DECODE_WORKERS = 4
+DECODE_QUEUE_SIZE = 8  # Decoded chunks waiting for inference (~2 MB each)
+WRITE_QUEUE_SIZE = 32  # Results waiting to be written
+
+# Adaptive analysis window (start short, extend only when the tags are undecided)
+ADAPTIVE_WINDOWS = (10, 20, CHUNK_DURATION)  # Seconds decoded at each stage
+ADAPTIVE_MARGIN = 0.02  # Scores this close to a threshold count as undecided
+
+# Cross-track batching (1 = analyse each track on its own)
+BATCH_SIZE = 1  # Tracks per model call
+BATCH_WAIT = 2.0  # Seconds to wait for a batch to fill before running it anyway
+EFFNET_BATCH = 64  # Fixed patch batch of discogs-effnet-bs64
+PATCH_SIZE = 128  # Mel frames per effnet patch
+PATCH_HOP = 62
+EFFNET_FRAME_SIZE = 512  # FrameCutter settings of TensorflowPredictEffnetDiscogs
+EFFNET_HOP_SIZE = 256
+PARITY_TOLERANCE = 1e-3  # Largest difference allowed between batched and standard embeddings (relative)
+
+# Multi-process mode (each worker process loads its own copy of the models)
+WORKERS = 1
+
+# CPU threads (0 = default: TensorFlow sizes its pools to the machine, split between workers)
+TF_INTRA_THREADS = 0  # Threads running a single TensorFlow operation
+TF_INTER_THREADS = 0  # TensorFlow operations run concurrently
+DECODER_THREADS = 0  # Threads per ffmpeg/av decode (each decode worker runs its own)
+
+# Watch mode (--watch: keep the models loaded and tag files as they arrive)
+WATCH_DEBOUNCE = 30  # Seconds without events (and with a stable size) before a new file is tagged
+WATCH_POLL_INTERVAL = 60  # Seconds between library scans when inotify is not available
+WATCH_RESCAN_INTERVAL = 3600  # Full scan even with inotify, to catch events that were missed
+WATCH_MAX_PENDING = 10000  # Files waiting out the debounce; more are left for the next scan
 
 # --- TAG CONFIGURATION ---
 # Format: "raw_model_tag": ("final_display_tag", threshold)
@@ -80,165 +181,779 @@ TAG_CONFIG = {
 # --- IGNORED TAGS (never written) ---
 IGNORED_TAGS = {"corporate", "advertising", "commercial", "children", "game", "christmas", "holiday", "nature", "funny", "retro", "sexy"}
 
-def read_middle_chunk(file_path):
-    try:
+# --- EXTRA CLASSIFIER HEADS ---
+# Other Essentia classifiers trained on discogs-effnet embeddings, run on the
+# embedding already computed for the mood tags. Each head writes its tags to its
+# own "field" ("grouping", "genre", "mood" or any other name, written as a custom
+# field), replacing its earlier tags there: the ones starting with its "prefix",
+# or the whole field with prefix "". "tags" maps classes like TAG_CONFIG; without
+# it every class scoring at least "threshold" is a tag. Optional: "max_tags" (1),
+# "ignored", "fallback_threshold" and "fallback_overrides".
+HEADS = {
+    # "danceability": {
+    #     "model": "/app/danceability-discogs-effnet-1.pb",
+    #     "meta": "/app/danceability-discogs-effnet-1.json",
+    #     "field": "grouping", "prefix": "dance_",
+    #     "tags": {"danceable": ("dance_danceable", 0.70)},
+    # },
+    # "genre": {
+    #     "model": "/app/genre_discogs400-discogs-effnet-1.pb",
+    #     "meta": "/app/genre_discogs400-discogs-effnet-1.json",
+    #     "field": "genre", "prefix": "", "threshold": 0.30, "max_tags": 2,
+    # },
+}
+
+def config_fingerprint():
+    # Changes whenever a setting that affects the written tags changes
+    settings = {
+        "tag_config": TAG_CONFIG, "fallback_overrides": FALLBACK_OVERRIDES,
+        "ignored_tags": sorted(IGNORED_TAGS), "fallback_threshold": FALLBACK_THRESHOLD,
+        "max_tags": MAX_TAGS, "chunk_duration": CHUNK_DURATION, "heads": HEADS,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def probe_duration(file_path, decoder=DECODER):
+    if decoder == "ffmpeg":
         probe = subprocess.run([
             'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
             '-of', 'default=noprint_wrappers=1:nokey=1', file_path
         ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try: return float(probe.stdout)
+        except ValueError: return 60
+
+    # In-process decoders take the duration from the stream info mutagen parses
+    try: return mutagen.File(file_path).info.length
+    except Exception: return 60
+
+def decode_ffmpeg(file_path, start_time, length, threads=DECODER_THREADS):
+    command = [
+        'ffmpeg', '-ss', str(start_time), '-t', str(length),
+        '-threads', str(threads), '-i', file_path, '-f', 'f32le', '-ac', '1', '-ar', '16000',
+        '-loglevel', 'quiet', 'pipe:1'
+    ]
 
-        try: duration = float(probe.stdout)
-        except ValueError: duration = 60
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if process.returncode != 0: return None
+    return np.frombuffer(process.stdout, dtype=np.float32)
 
-        start_time = max(0, (duration / 2) - (CHUNK_DURATION / 2))
+def decode_essentia(file_path, start_time, length, threads=DECODER_THREADS):
+    from essentia.standard import EasyLoader
+    loader = EasyLoader(filename=file_path, sampleRate=16000, downmix='mix',
+                        startTime=start_time, endTime=start_time + length)
+    return np.asarray(loader(), dtype=np.float32)
 
-        command = [
-            'ffmpeg', '-ss', str(start_time), '-t', str(CHUNK_DURATION),
-            '-i', file_path, '-f', 'f32le', '-ac', '1', '-ar', '16000',
-            '-loglevel', 'quiet', 'pipe:1'
-        ]
+def decode_av(file_path, start_time, length, threads=DECODER_THREADS):
+    try: import av
+    except ImportError: return None
+    wanted = int(length * 16000)
+    chunks = []
+    with av.open(file_path) as container:
+        stream = container.streams.audio[0]
+        if threads:
+            stream.thread_count = threads
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=16000)
+        # Seeking lands on the packet before start_time, the excess is trimmed below
+        if start_time > 0:
+            container.seek(int(start_time * av.time_base))
+        skip = None
+        for frame in container.decode(stream):
+            if skip is None:
+                skip = max(0, int(round((start_time - (frame.time or 0)) * 16000)))
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+            if sum(len(c) for c in chunks) >= skip + wanted: break
+        else:
+            for resampled in resampler.resample(None):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+    if not chunks: return None
+    audio = np.concatenate(chunks).astype(np.float32, copy=False)
+    return audio[skip:skip + wanted]
+
+DECODERS = {"ffmpeg": decode_ffmpeg, "essentia": decode_essentia, "av": decode_av}
+
+def read_middle_chunk(file_path, decoder=DECODER, length=CHUNK_DURATION, timings=None, threads=DECODER_THREADS):
+    try:
+        with stage(timings, "probe"):
+            duration = probe_duration(file_path, decoder)
+        start_time = max(0, (duration / 2) - (length / 2))
 
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        if process.returncode != 0: return None
-        return np.frombuffer(process.stdout, dtype=np.float32)
+        with stage(timings, "decode"):
+            try: audio = DECODERS[decoder](file_path, start_time, length, threads)
+            except Exception: audio = None
+            # Fall back to the ffmpeg subprocesses when an in-process decoder fails
+            if audio is None and decoder != "ffmpeg":
+                audio = decode_ffmpeg(file_path, start_time, length, threads)
+        return audio
     except Exception:
         return None
 
-def get_ai_tags(file_path, embedding_model, classifier_model, classes):
-    audio = read_middle_chunk(file_path)
-    if audio is None or len(audio) < 16000: return []
+def load_embedding_model():
+    with stage(_startup, "essentia import"):
+        from essentia.standard import TensorflowPredictEffnetDiscogs
+    with stage(_startup, "model load"):
+        return TensorflowPredictEffnetDiscogs(
+            graphFilename=EMBEDDING_MODEL_FILE,
+            output="PartitionedCall:1"
+        )
 
-    try:
-        embeddings = embedding_model(audio)
-        avg_embeddings = np.mean(embeddings, axis=0, keepdims=True)
-        predictions = classifier_model(avg_embeddings)
-        avg_predictions = predictions[0]
+def load_classifier_model(model_file=CLASSIFIER_MODEL_FILE, meta_file=META_FILE):
+    # Input and output node names differ between classifier heads
+    with open(meta_file, 'r') as f:
+        input_name, output_name = classifier_io(json.load(f))
+    with stage(_startup, "essentia import"):
+        from essentia.standard import TensorflowPredict2D
+    with stage(_startup, "model load"):
+        return TensorflowPredict2D(graphFilename=model_file, input=input_name, output=output_name)
 
-        indices = np.argsort(avg_predictions)[::-1]
+def load_models():
+    return load_embedding_model(), load_classifier_model()
 
-        final_tags = []
-        debug_output = []
-        fallback_candidate = None
+def load_heads():
+    return [Head(name, config, EMBEDDING_MODEL_FILE, EMBEDDING_DIM) for name, config in HEADS.items()]
 
-        for i in indices:
-            if len(final_tags) >= MAX_TAGS: break
+def load_head_model(head):
+    return load_classifier_model(head.model_file, head.meta_file)
 
-            score = avg_predictions[i]
-            raw_tag = classes[i]
+def load_patch_model():
+    # Raw effnet graph, fed with mel patches of several tracks at once
+    with stage(_startup, "essentia import"):
+        from essentia.standard import TensorflowPredict
+    with stage(_startup, "model load"):
+        return TensorflowPredict(
+            graphFilename=EMBEDDING_MODEL_FILE,
+            inputs=["serving_default_melspectrogram"],
+            outputs=["PartitionedCall:1"]
+        )
 
-            # Skip ignored tags
-            if raw_tag in IGNORED_TAGS:
-                continue
+class LazyModel:
+    """Loads a model on its first call, so runs where no file reaches inference never start TensorFlow"""
 
-            # Skip tags not in the config
-            if raw_tag not in TAG_CONFIG:
-                continue
+    def __init__(self, load):
+        self.load = load
+        self.model = None
 
-            display_tag, threshold = TAG_CONFIG[raw_tag]
+    def __call__(self, *args):
+        if self.model is None:
+            self.model = self.load()
+        return self.model(*args)
 
-            # Track best fallback candidate with tag-specific thresholds
-            if fallback_candidate is None and score >= FALLBACK_THRESHOLD:
-                min_fallback = FALLBACK_OVERRIDES.get(raw_tag, FALLBACK_THRESHOLD)
-                if score >= min_fallback:
-                    fallback_candidate = (raw_tag, display_tag, score)
+def mel_patches(audio, mel_extractor):
+    # Same framing and patching as TensorflowPredictEffnetDiscogs: frames from the first
+    # sample, whole frames only (FrameGenerator defaults centre the first frame and keep
+    # partial ones). Checked against the model by patch_parity
+    from essentia.standard import FrameGenerator
+    frames = [mel_extractor(frame) for frame in FrameGenerator(audio, frameSize=EFFNET_FRAME_SIZE, hopSize=EFFNET_HOP_SIZE,
+                                                               startFromZero=True, validFrameThresholdRatio=1)]
+    if len(frames) < PATCH_SIZE: return None
+    frames = np.array(frames, dtype=np.float32)
+    starts = range(0, len(frames) - PATCH_SIZE + 1, PATCH_HOP)
+    return np.stack([frames[i:i + PATCH_SIZE] for i in starts])
 
-            if score < threshold:
-                continue
+def compute_embeddings_batch(audios, embedding_model, patch_model):
+    # Pack the patches of all tracks into full effnet batches instead of
+    # zero-padding a mostly empty batch for every track
+    import essentia
+    from essentia.standard import TensorflowInputMusiCNN
+    mel_extractor = TensorflowInputMusiCNN()
+    patches, owners, embeddings = [], [], [None] * len(audios)
+    for n, audio in enumerate(audios):
+        track_patches = mel_patches(audio, mel_extractor)
+        if track_patches is None:
+            # Too short to fill a single patch, let the standard algorithm handle it
+            embeddings[n] = np.mean(embedding_model(audio), axis=0)
+            continue
+        patches.append(track_patches)
+        owners.extend([n] * len(track_patches))
+    if not patches: return embeddings
 
-            if display_tag not in final_tags:
-                final_tags.append(display_tag)
-                debug_output.append(f"{raw_tag} ({score*100:.1f}%)")
+    patches = np.concatenate(patches)
+    outputs = []
+    for i in range(0, len(patches), EFFNET_BATCH):
+        batch = patches[i:i + EFFNET_BATCH]
+        real = len(batch)
+        if real < EFFNET_BATCH:
+            batch = np.concatenate([batch, np.zeros((EFFNET_BATCH - real,) + batch.shape[1:], dtype=np.float32)])
+        pool = essentia.Pool()
+        pool.set("serving_default_melspectrogram", batch[:, np.newaxis, :, :])
+        output = np.asarray(patch_model(pool)["PartitionedCall:1"])
+        outputs.append(output.reshape(EFFNET_BATCH, -1)[:real])
 
-        # Fallback: if no tags found, use best candidate
-        if not final_tags and fallback_candidate:
-            raw_tag, display_tag, score = fallback_candidate
-            final_tags.append(display_tag)
-            debug_output.append(f"{raw_tag} ({score*100:.1f}%)*")
+    outputs = np.concatenate(outputs)
+    owners = np.array(owners)
+    for n in set(owners.tolist()):
+        embeddings[n] = outputs[owners == n].mean(axis=0)
+    return embeddings
 
-        if final_tags:
-            print(f"   {os.path.basename(file_path)}: {', '.join(debug_output)}")
+def patch_parity(audio, embedding_model, patch_model):
+    """Largest difference between the batched and the standard embedding of a track, relative to the largest value"""
+    expected = np.mean(embedding_model(audio), axis=0)
+    batched = compute_embeddings_batch([audio], embedding_model, patch_model)[0]
+    return float(np.max(np.abs(batched - expected)) / max(float(np.max(np.abs(expected))), 1e-12))
+
+def compute_predictions_batch(audios, embedding_model, classifier_model, patch_model=None, timings=None):
+    with stage(timings, "embedding"):
+        if patch_model is None:
+            embeddings = [np.mean(embedding_model(audio), axis=0) for audio in audios]
         else:
-            print(f"   {os.path.basename(file_path)}: (No mood tags above threshold)")
+            embeddings = compute_embeddings_batch(audios, embedding_model, patch_model)
+    # One classifier call for the whole batch (N x D -> N x classes)
+    with stage(timings, "classifier"):
+        avg_embeddings = np.stack(embeddings)
+        predictions = classifier_model(avg_embeddings)
+    return avg_embeddings, predictions
 
-        return final_tags
+_tag_rules = {}
 
-    except Exception as e:
-        print(f"   Error: {os.path.basename(file_path)} - {e}")
-        return []
+def get_tag_rules(classes):
+    # Compile the tag configuration once per class list
+    key = tuple(classes)
+    if key not in _tag_rules:
+        _tag_rules[key] = TagRules(classes, TAG_CONFIG, IGNORED_TAGS, FALLBACK_OVERRIDES, FALLBACK_THRESHOLD, MAX_TAGS)
+    return _tag_rules[key]
+
+def run_heads(results, heads, timed=False):
+    # Every (head, model) pair on the embeddings of the results at once; cached and
+    # duplicate results have their embedding too, so no track needs the effnet again
+    head_timings = {} if timed else None
+    with stage(head_timings, "classifier"):
+        embeddings = np.stack([result["embedding"] for result in results]).astype(np.float32)
+        outputs = [(head, np.atleast_2d(model(embeddings))) for head, model in heads]
+    for result in results:
+        result["heads"] = {}
+    for head, predictions in outputs:
+        for result, scores, (tags, debug) in zip(results, predictions, head.decide(predictions)):
+            result["heads"][head.name] = {"tags": tags, "debug": debug, "predictions": scores}
+    if timed:
+        for result in results:
+            result["timings"] = add_timings(result["timings"], {"classifier": head_timings["classifier"] / len(results)})
+
+def analyze_batch(items, embedding_model, classifier_model, classes, cache=None, patch_model=None, timed=False,
+                  duplicates=None, heads=()):
+    # Analyse (path, audio) pairs together; each result's status is tagged,
+    # untagged, decode_error, short_audio or error. With a duplicates index,
+    # unmatched results carry their "fingerprint" for the caller to index.
+    # Extra (head, model) pairs add their decisions under "heads"
+    results = []
+    todo = []
+    for file_path, audio in items:
+        result = {"path": file_path, "status": None, "tags": [], "debug": [], "error": None, "cached": False}
+        if timed: result["timings"] = {}
+        results.append(result)
+        if audio is None:
+            result["status"] = "decode_error"
+            continue
+        if len(audio) < 16000:
+            result["status"] = "short_audio"
+            continue
+
+        # Reuse predictions for audio that was already analysed with the same models
+        key = None
+        if cache is not None:
+            key = audio_key(audio)
+            cached = cache.get(key)
+            if cached is not None:
+                result["embedding"], result["predictions"] = cached
+                result["cached"] = True
+
+        # Reuse the predictions of the same recording found in another file
+        if duplicates is not None:
+            with stage(result.get("timings"), "fingerprint"):
+                fingerprint = audio_fingerprint(audio)
+                match = duplicates.match(fingerprint, file_path)
+            if match is None:
+                result["fingerprint"] = fingerprint
+            else:
+                recording, embedding, predictions = match
+                if not result["cached"]:
+                    result["embedding"], result["predictions"] = embedding, predictions
+                result["duplicate_of"] = recording
+                duplicates.link(file_path, recording)
+        if not result["cached"] and "duplicate_of" not in result:
+            todo.append((result, audio, key))
+
+    if todo:
+        try:
+            batch_timings = {} if timed else None
+            avg_embeddings, predictions = compute_predictions_batch(
+                [audio for _, audio, _ in todo], embedding_model, classifier_model, patch_model, batch_timings)
+            for (result, _, key), embedding, avg_predictions in zip(todo, avg_embeddings, predictions):
+                result["embedding"], result["predictions"] = embedding, avg_predictions
+                if timed:
+                    # Model time of a batch is shared evenly between its tracks
+                    shares = {name: seconds / len(todo) for name, seconds in batch_timings.items()}
+                    result["timings"] = add_timings(result["timings"], shares)
+                if cache is not None:
+                    cache.put(key, embedding, avg_predictions)
+        except Exception as e:
+            for result, _, _ in todo:
+                result["status"] = "error"
+                result["error"] = str(e)
+
+    # Tag decision for the whole batch at once
+    decided = [result for result in results if result["status"] is None]
+    if decided:
+        try:
+            if heads:
+                run_heads(decided, heads, timed)
+            decisions = get_tag_rules(classes).decide(np.stack([result["predictions"] for result in decided]))
+            for result, (final_tags, debug_output) in zip(decided, decisions):
+                result["tags"], result["debug"] = final_tags, debug_output
+                result["status"] = "tagged" if final_tags else "untagged"
+        except Exception as e:
+            for result in decided:
+                result["status"] = "error"
+                result["error"] = str(e)
+
+    return results
+
+def window_is_decisive(result, classes):
+    # Undecided when the fallback pass was needed, or when any output tag's
+    # best score sits within ADAPTIVE_MARGIN of its threshold
+    if result["status"] != "tagged" or result["debug"][0].endswith("*"): return False
+    margins = {}
+    for score, raw_tag in zip(result["predictions"], classes):
+        if raw_tag in IGNORED_TAGS or raw_tag not in TAG_CONFIG: continue
+        display_tag, threshold = TAG_CONFIG[raw_tag]
+        margins[display_tag] = max(margins.get(display_tag, -1.0), score - threshold)
+    return all(abs(m) >= ADAPTIVE_MARGIN for m in margins.values())
+
+def extend_windows(results, decode, analyze, classes, verify=False):
+    # Re-analyse undecided tracks with the next, longer window. Only classified results
+    # have a window (not decode errors, short files or predictions reused from a duplicate)
+    for result in results:
+        if result["status"] in ("tagged", "untagged") and "duplicate_of" not in result: result["window"] = ADAPTIVE_WINDOWS[0]
+    for window in ADAPTIVE_WINDOWS[1:]:
+        undecided = [i for i, r in enumerate(results) if "window" in r and not window_is_decisive(r, classes)]
+        if not undecided: break
+        for i, result in zip(undecided, analyze([(results[i]["path"], decode(results[i]["path"], window)) for i in undecided])):
+            if result["status"] not in ("tagged", "untagged"): continue  # Keep the shorter window's result
+            result["window"] = window
+            if "timings" in results[i]:
+                result["timings"] = add_timings(results[i]["timings"], result["timings"])
+            results[i] = result
+
+    # Compare against the full-length analysis to measure agreement
+    if verify:
+        for result in results:
+            if "window" not in result: continue
+            if result["window"] == CHUNK_DURATION:
+                result["full_tags"] = result["tags"]
+            else:
+                full = analyze([(result["path"], decode(result["path"], CHUNK_DURATION))])[0]
+                result["full_tags"] = full["tags"]
+                if "timings" in result:
+                    result["timings"] = add_timings(result["timings"], full["timings"])
+    return results
+
+def checked_patch_model(batching, items, embedding_model):
+    # Batched embeddings must match the standard ones: checked on the first track long
+    # enough for a patch, otherwise tracks are embedded one at a time.
+    # batching is {"model": patch model or None, "checked": False} at first
+    if batching["model"] is None or batching["checked"]: return batching["model"]
+    audio = next((audio for _, audio in items if audio is not None
+                  and len(audio) >= EFFNET_FRAME_SIZE + EFFNET_HOP_SIZE * PATCH_SIZE), None)
+    if audio is None: return batching["model"]
+    batching["checked"] = True
+    difference = patch_parity(audio, embedding_model, batching["model"])
+    if difference > PARITY_TOLERANCE:
+        print(f"Warning: batched embeddings differ from discogs-effnet by {difference:.1%}, embedding tracks one at a time.")
+        batching["model"] = None
+    return batching["model"]
+
+def make_analyzer(classes, cache, options, duplicates=None):
+    # Build the decode/analyze stages shared by every execution mode. The models
+    # are loaded at the first file that needs inference, not before
+    loading = []
+
+    def lazy(load):
+        def load_now():
+            if not loading and multiprocessing.parent_process() is None:
+                print(f"Loading models ({', '.join(['discogs-effnet', 'mtg-jamendo-moodtheme'] + list(HEADS))})...")
+            loading.append(load)
+            return load()
+        return LazyModel(load_now)
+
+    embedding_model, classifier_model = lazy(load_embedding_model), lazy(load_classifier_model)
+    heads = [(head, lazy(lambda head=head: load_head_model(head))) for head in load_heads()]
+    batching = {"model": lazy(load_patch_model) if options["batch_size"] > 1 else None, "checked": False}
+    first_window = ADAPTIVE_WINDOWS[0] if options["adaptive"] else CHUNK_DURATION
+    timed = options["metrics"]
+    decode_timings = {}  # Path -> probe/decode timings until its result is built
+
+    def decode(path, length=first_window):
+        timings = decode_timings.setdefault(path, {}) if timed else None
+        return read_middle_chunk(path, options["decoder"], length, timings, options["decoder_threads"])
+
+    def analyze_window(items, duplicates=None):
+        patch_model = checked_patch_model(batching, items, embedding_model)
+        return analyze_batch(items, embedding_model, classifier_model, classes, cache, patch_model, timed, duplicates, heads)
+
+    def analyze(items):
+        # Duplicates are looked up on the first window, and indexed with the final predictions
+        results = analyze_window(items, duplicates)
+        fingerprints = {result["path"]: result.pop("fingerprint") for result in results if "fingerprint" in result}
+        if options["adaptive"]:
+            results = extend_windows(results, decode, analyze_window, classes, options["adaptive_verify"])
+        for result in results:
+            if result["path"] in fingerprints and result["status"] in ("tagged", "untagged"):
+                duplicates.add(result["path"], fingerprints[result["path"]], result["embedding"], result["predictions"])
+        if timed:
+            for result in results:
+                result["timings"] = add_timings(decode_timings.pop(result["path"], None), result["timings"])
+        return results
+
+    return decode, analyze
+
+def report_result(result):
+    filename = os.path.basename(result["path"])
+    if result["status"] == "tagged":
+        print(f"   {filename}: {', '.join(result['debug'])}")
+    elif result["status"] == "untagged":
+        print(f"   {filename}: (No mood tags above threshold)")
+    elif result["status"] == "error":
+        print(f"   Error: {filename} - {result['error']}")
+    for name, decided in result.get("heads", {}).items():
+        if decided["debug"]:
+            print(f"      {name}: {', '.join(decided['debug'])}")
+
+def succeeded(status, action):
+    # Analysed and its tags written (or already there); anything else is retried by the next run
+    return status in ("tagged", "untagged") and action in (None, "saved", "unchanged")
+
+def head_fields(result, heads):
+    # (field, prefix, tags) of every configured head that found tags for the result
+    decided = result.get("heads", {})
+    return [(head.field, head.prefix, decided[head.name]["tags"]) for head in heads
+            if decided.get(head.name, {}).get("tags")]
+
+# --- WORKER PROCESSES ---
+_worker_state = {}
+
+def configure_threads(workers, intra=TF_INTRA_THREADS, inter=TF_INTER_THREADS):
+    # TensorFlow reads these when it starts, at the first model load (worker
+    # processes inherit them). With several workers, split the cores between
+    # them, otherwise every worker sizes its intra-op pool to the whole machine
+    if intra: os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra)
+    if inter: os.environ["TF_NUM_INTEROP_THREADS"] = str(inter)
+    if workers > 1:
+        os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+        os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+    if "TF_NUM_INTRAOP_THREADS" in os.environ:
+        os.environ.setdefault("OMP_NUM_THREADS", os.environ["TF_NUM_INTRAOP_THREADS"])
+    return os.environ.get("TF_NUM_INTRAOP_THREADS", "default")
+
+def open_duplicates(adaptive):
+    # Stored predictions depend on the decoded windows as well as the models
+    windows = ADAPTIVE_WINDOWS if adaptive else (CHUNK_DURATION,)
+    settings = json.dumps({"windows": windows, "margin": ADAPTIVE_MARGIN if adaptive else None})
+    return DuplicateIndex(DUPLICATES_FILE, [EMBEDDING_MODEL_FILE, CLASSIFIER_MODEL_FILE, META_FILE], settings)
 
-def append_tags_to_file(path, new_tags):
-    if not new_tags: return
+def init_worker(classes, options):
+    # Runs once per worker process: load the models and open the shared cache and duplicates index
+    cache = duplicates = None
+    if options["cache"]:
+        cache = PredictionCache(CACHE_FILE, [EMBEDDING_MODEL_FILE, CLASSIFIER_MODEL_FILE, META_FILE], max_mb=CACHE_MAX_MB)
+    if options["duplicates"]:
+        duplicates = open_duplicates(options["adaptive"])
+    _worker_state["decode"], _worker_state["analyze"] = make_analyzer(classes, cache, options, duplicates)
 
+def analyze_in_worker(paths):
+    # Results go back to the parent, which owns console output and tag writing
+    decode, analyze = _worker_state["decode"], _worker_state["analyze"]
+    return analyze([(path, decode(path)) for path in paths])
+
+class TagBlockFull(Exception):
+    """The new tags do not fit in the existing tag block"""
+
+def write_padding(stats, in_place_only=False):
+    # Reuse the padding already in the file when the new tags fit, so only the
+    # tag block is rewritten in place; otherwise grow it with room to spare
+    def padding(info):
+        if info.padding >= 0: return info.padding
+        # mutagen asks for the padding before writing anything, so this aborts the save untouched
+        if in_place_only: raise TagBlockFull()
+        return max(info.get_default_padding(), WRITE_PADDING)
+    return padding
+
+def save_tags(audio, path, stats):
+    # Tags that fit in the tag block of an MP3 or FLAC file are overwritten in place, in
+    # one write before the audio data. Anything else is done on a temporary copy next to
+    # the file, synced, and renamed over the original, so an interrupted save leaves the
+    # original file intact: a tag block that has to grow moves the audio data, and MP4
+    # tags live in the moov atom, whose sizes and offsets are patched in several writes
+    stats["rewritten"] = False
+    if not isinstance(audio, MP4):
+        try:
+            audio.save(path, padding=write_padding(stats, in_place_only=True))
+            return
+        except TagBlockFull:
+            pass
+
+    stats["rewritten"] = True
+    target = os.path.realpath(path)  # Replace the file a symlink points to, not the link
+    directory, name = os.path.split(target)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
     try:
-        updated = False
-        filename = os.path.basename(path)
+        with os.fdopen(fd, 'wb') as temp, open(target, 'rb') as original:
+            shutil.copyfileobj(original, temp)
+        st = os.stat(target)
+        os.chmod(temp_path, st.st_mode & 0o7777)
+        try: os.chown(temp_path, st.st_uid, st.st_gid)
+        except OSError: pass
+        audio.save(temp_path, padding=write_padding(stats))
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, target)
+    except BaseException:
+        try: os.remove(temp_path)
+        except OSError: pass
+        raise
+
+# Tag fields that heads can write: (ID3 frame, Vorbis comment, MP4 atom)
+TAG_FIELDS = {
+    "grouping": ("TIT1", "GROUPING", "\xa9grp"),
+    "genre":    ("TCON", "GENRE", "\xa9gen"),
+    "mood":     ("TMOO", "MOOD", "----:com.apple.iTunes:MOOD"),
+}
+
+def field_keys(field):
+    # Other fields are written as custom text fields
+    return TAG_FIELDS.get(field) or (f"TXXX:{field}", field.upper(), f"----:com.apple.iTunes:{field}")
+
+def merge_tags(current_tags, new_tags, prefix="mood_"):
+    # Remove old tags with the prefix but keep other tags, then add the new ones
+    merged = [t for t in current_tags if not t.startswith(prefix)]
+    for tag in new_tags:
+        if tag not in merged:
+            merged.append(tag)
+    return merged
+
+def split_tags(values):
+    return [t.strip() for t in values[0].split(";")] if values else []
+
+def mp4_text(value):
+    return bytes(value).decode("utf-8", "replace") if isinstance(value, MP4FreeForm) else value
+
+def append_tags_to_file(path, new_tags, dry_run=False, fields=()):
+    # Mood tags go to the grouping field, (field, prefix, tags) of the extra heads to theirs, in one save.
+    # Returns {"action": saved, unchanged, planned or error, "bytes": bytes of a full-file rewrite}
+    outcome = {"action": "unchanged", "bytes": 0}
+    updates = [update for update in [("grouping", "mood_", new_tags)] + list(fields) if update[2]]
+    if not updates: return outcome
+
+    try:
+        stats = {}
         ext = path.lower()
+        changed = []  # (field, value shown)
 
         # --- MP3 ---
         if ext.endswith(".mp3"):
             try: audio = ID3(path)
             except ID3NoHeaderError: audio = ID3()
-            current_tags = []
-            existing_frames = audio.getall("TIT1")
-            if existing_frames:
-                current_tags = [t.strip() for t in existing_frames[0].text[0].split(";")]
-            # Remove old mood_* tags but keep other tags
-            current_tags = [t for t in current_tags if not t.startswith("mood_")]
-            # Add new mood tags
-            for tag in new_tags:
-                if tag not in current_tags:
-                    current_tags.append(tag)
-                    updated = True
-            if updated or existing_frames:  # Update if changed or had mood tags before
-                final_str = "; ".join(current_tags)
-                audio["TIT1"] = TIT1(encoding=3, text=final_str)
-                audio.save(path)
-                print(f"   Saved MP3: {final_str}")
+            for field, prefix, tags in updates:
+                key = field_keys(field)[0]
+                existing_frames = audio.getall(key)
+                current_tags = split_tags(existing_frames[0].text) if existing_frames else []
+                final_str = "; ".join(merge_tags(current_tags, tags, prefix))
+                if existing_frames and list(existing_frames[0].text) == [final_str]: continue
+                changed.append((field, final_str))
+                if key.startswith("TXXX:"):
+                    audio[key] = TXXX(encoding=3, desc=key[len("TXXX:"):], text=final_str)
+                else:
+                    audio[key] = Frames[key](encoding=3, text=final_str)
+            if not changed: return outcome
+            label = "MP3"
+            if not dry_run:
+                save_tags(audio, path, stats)
 
         # --- FLAC ---
         elif ext.endswith(".flac"):
             audio = FLAC(path)
-            current_tags = audio.get("GROUPING", [])
-            # Remove old mood_* tags but keep other tags
-            current_tags = [t for t in current_tags if not t.startswith("mood_")]
-            # Add new mood tags
-            for tag in new_tags:
-                if tag not in current_tags:
-                    current_tags.append(tag)
-                    updated = True
-            if updated or audio.get("GROUPING"):  # Update if changed or had tags before
-                audio["GROUPING"] = current_tags
-                audio.save()
-                print(f"   Saved FLAC: {new_tags}")
+            for field, prefix, tags in updates:
+                key = field_keys(field)[1]
+                final_tags = merge_tags(audio.get(key, []), tags, prefix)
+                if audio.get(key, []) == final_tags: continue
+                changed.append((field, tags))
+                audio[key] = final_tags
+            if not changed: return outcome
+            label = "FLAC"
+            if not dry_run:
+                save_tags(audio, path, stats)
 
         # --- M4A / MP4 ---
         elif ext.endswith((".m4a", ".mp4")):
             try:
                 audio = MP4(path)
-                current_tags = []
-                current_raw = audio.tags.get("\xa9grp", [])
-                if current_raw:
-                    current_tags = [t.strip() for t in current_raw[0].split(";")]
-                # Remove old mood_* tags but keep other tags
-                current_tags = [t for t in current_tags if not t.startswith("mood_")]
-                # Add new mood tags
-                for tag in new_tags:
-                    if tag not in current_tags:
-                        current_tags.append(tag)
-                        updated = True
-                if updated or current_raw:  # Update if changed or had tags before
-                    final_str = "; ".join(current_tags)
-                    audio.tags["\xa9grp"] = [final_str]
-                    audio.save()
-                    print(f"   Saved M4A: {final_str}")
+                if audio.tags is None: audio.add_tags()
+                for field, prefix, tags in updates:
+                    key = field_keys(field)[2]
+                    current_raw = [mp4_text(value) for value in audio.tags.get(key, [])]
+                    final_str = "; ".join(merge_tags(split_tags(current_raw), tags, prefix))
+                    if current_raw == [final_str]: continue
+                    changed.append((field, final_str))
+                    audio.tags[key] = [MP4FreeForm(final_str.encode()) if key.startswith("----") else final_str]
+                if not changed: return outcome
+                label = "M4A"
+                if not dry_run:
+                    save_tags(audio, path, stats)
             except Exception as e:
                 print(f"   M4A Error: {e}")
+                outcome["action"] = "error"
+                return outcome
+
+        else:
+            return outcome
+
+        shown = " | ".join(str(value) if field == "grouping" else f"{field}: {value}" for field, value in changed)
+        if dry_run:
+            print(f"   Would save {label}: {shown}")
+            outcome["action"] = "planned"
+            return outcome
+
+        # Saves through a temporary copy rewrite the whole file; otherwise only the
+        # tag block was overwritten in place
+        if stats.get("rewritten", True):
+            outcome["bytes"] = os.path.getsize(path)
+        outcome["action"] = "saved"
+        print(f"   Saved {label}: {shown}")
 
     except Exception as e:
         print(f"   Write Error: {e}")
+        outcome["action"] = "error"
+
+    return outcome
 
 # --- MAIN ---
-if __name__ == "__main__":
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk: return
+        yield chunk
+
+def watch_library(args, manifest, stores, process, duplicates=None):
+    # Tag files as they arrive, with the models loaded by the initial pass kept warm
+    watcher, mode = open_watcher(MUSIC_FOLDER, WATCH_POLL_INTERVAL, args.watch_poll)
+    debouncer = Debouncer(WATCH_DEBOUNCE, WATCH_MAX_PENDING)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())  # docker stop: finish the current batch first
+    next_rescan = time.monotonic() + WATCH_RESCAN_INTERVAL
+    print(f"Watching {MUSIC_FOLDER} for new files ({mode}, Ctrl+C to stop)...")
+
+    try:
+        while not stop.is_set():
+            paths, rescan = watcher.poll(1.0)
+            debouncer.add(path for path in paths
+                          if matches_filters(path, MUSIC_FOLDER, args.extensions, args.include, args.exclude))
+            if debouncer.overflowed:
+                # Files dropped from the queue are picked up by a scan once this burst is handled
+                debouncer.overflowed = False
+                next_rescan = min(next_rescan, time.monotonic() + WATCH_DEBOUNCE)
+            if rescan or time.monotonic() >= next_rescan:
+                manifest.begin_scan()
+                debouncer.add(path for path in iter_audio_files(MUSIC_FOLDER, args.extensions, args.include, args.exclude)
+                              if manifest.classify(path) != "unchanged")
+                forget(manifest.end_scan(), manifest, stores, duplicates)
+                next_rescan = time.monotonic() + WATCH_RESCAN_INTERVAL
+
+            ready = debouncer.ready()
+            if not ready: continue
+            deleted = [path for path in ready if not os.path.exists(path)]
+            if deleted:
+                forget(deleted, manifest, stores, duplicates)
+            # Our own tag writes also raise events, but leave the file matching the manifest
+            todo = [path for path in ready if path not in deleted and manifest.status(path) != "unchanged"]
+            if todo:
+                print(f"{len(todo)} new or modified files...")
+                process(todo)
+            manifest.commit()  # Flushes the stores too
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    print("Stopped watching.")
+
+def print_startup():
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _startup.items())
+    print(f"Startup: {phases}")
+
+def flush_stores(stores):
+    for store in stores:
+        store.flush()
+
+def close_stores(stores):
+    for store in stores:
+        store.close()
+
+def forget(deleted, manifest, stores, duplicates=None):
+    # Deleted rows are only marked; similarity queries skip them without a new projection
+    manifest.forget(deleted)
+    for store in stores:
+        store.remove(deleted)
+    if duplicates is not None:
+        duplicates.forget(deleted)
+
+def finish_scan(manifest, stores, changes, duplicates=None, forget_deleted=True):
+    # Report the library changes once discovery is complete and drop deleted files
+    deleted = manifest.end_scan()
+    if forget_deleted:
+        forget(deleted, manifest, stores, duplicates)
+    total = sum(changes.values())
+    print(f"Library: {total} files | {changes['new']} new, {changes['changed']} changed, "
+          f"{changes['reconfigured']} with older config, {len(deleted)} deleted, {changes['unchanged']} unchanged")
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag a music library with mood metadata.")
+    parser.add_argument("--full", action="store_true", help="Process every file, ignoring the manifest of already processed files")
+    parser.add_argument("--ext", dest="extensions", type=parse_extensions, default=AUDIO_EXTENSIONS, help="Comma-separated file extensions to process (default: mp3,flac,m4a,mp4)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB", help="Only process files matching this glob (relative to the music folder, repeatable)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="Skip files and folders matching this glob (repeatable)")
+    parser.add_argument("--resume", action="store_true", help="Skip the files finished by an interrupted run (also with --full)")
+    parser.add_argument("--time-budget", type=parse_duration, metavar="DURATION", help="Stop taking new files when the estimated time runs out (e.g. 5400, 90m, 1.5h); files are taken by priority")
+    parser.add_argument("--max-files", type=int, help="Process at most this many files, by priority")
+    parser.add_argument("--dry-run", action="store_true", help="Report the planned tag changes without writing any file")
+    parser.add_argument("--decoder", choices=sorted(DECODERS), default=DECODER, help="Audio decoder: ffmpeg subprocesses, or essentia/av in-process (falls back to ffmpeg)")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS, help="Decoder threads feeding the inference stage (0 = process files one at a time)")
+    parser.add_argument("--decode-queue", type=int, default=DECODE_QUEUE_SIZE, help="Maximum decoded chunks waiting for inference")
+    parser.add_argument("--write-queue", type=int, default=WRITE_QUEUE_SIZE, help="Maximum results waiting to be written")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Tracks run through the models together (1 = no cross-track batching)")
+    parser.add_argument("--batch-wait", type=float, default=BATCH_WAIT, help="Seconds to wait for a batch to fill before running it")
+    parser.add_argument("--adaptive", action="store_true", help="Start with a short window and extend it only for undecided tracks")
+    parser.add_argument("--adaptive-verify", action="store_true", help="With --adaptive, also run the full window to report how often the tags agree")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes, each with its own copy of the models (1 = single process)")
+    parser.add_argument("--tf-intra-threads", type=int, default=TF_INTRA_THREADS, help="TensorFlow threads per operation (0 = default)")
+    parser.add_argument("--tf-inter-threads", type=int, default=TF_INTER_THREADS, help="TensorFlow operations run in parallel (0 = default)")
+    parser.add_argument("--decoder-threads", type=int, default=DECODER_THREADS, help="Threads per ffmpeg/av decode (0 = decoder default)")
+    parser.add_argument("--metrics", metavar="FILE", help="Time every stage per file and write the metrics (.json summary or .csv rows per file)")
+    parser.add_argument("--profile", metavar="FILE", help="Run under cProfile and write the stats to FILE (main thread only)")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="Analyse only shard I of N (0-based, by path hash) and write the results to a shard file instead of the music files")
+    parser.add_argument("--shard-output", metavar="FILE", help="Results file of --shard (default: .tagger/shards/shard-I-of-N.jsonl)")
+    parser.add_argument("--apply-shards", nargs="*", metavar="PATH", help="Merge the shard files (or folders of them, default .tagger/shards) and write their tags")
+    parser.add_argument("--watch", action="store_true", help="After tagging the library, keep the models loaded and tag new or modified files as they arrive")
+    parser.add_argument("--watch-poll", action="store_true", help="With --watch, scan the library periodically instead of using inotify")
+    args = parser.parse_args()
+    if args.watch and args.dry_run:
+        parser.error("--watch cannot be combined with --dry-run")
+    limited = args.time_budget is not None or args.max_files is not None
+    if args.watch and limited:
+        parser.error("--watch cannot be combined with --time-budget or --max-files")
+    if args.shard and args.watch:
+        parser.error("--shard cannot be combined with --watch")
+    if args.apply_shards is not None and (args.shard or args.watch or limited):
+        parser.error("--apply-shards cannot be combined with --shard, --watch, --time-budget or --max-files")
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        try: profiler.runcall(run, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {args.profile}")
+    else:
+        run(args)
+
+def run(args):
+    run_started = time.perf_counter()
+    budget = Budget(args.time_budget, time.monotonic()) if args.time_budget is not None or args.max_files is not None else None
     print("--- Music Mood Tagger ---")
 
     if not os.path.exists(MUSIC_FOLDER):
@@ -259,28 +974,364 @@ if __name__ == "__main__":
     print(f"Model classes: {len(classes)} | Mapped to: {len(unique_outputs)} output tags")
     print(f"Fallback threshold: {FALLBACK_THRESHOLD*100:.0f}% (love: 15%) | Max tags: {MAX_TAGS}")
     print(f"Ignored tags: {', '.join(sorted(IGNORED_TAGS))}")
+    try: heads = load_heads()
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: {e}")
+        exit(1)
+    if heads:
+        print(f"Extra heads: {', '.join(f'{head.name} ({len(head.classes)} classes) -> {head.field}' for head in heads)}")
 
-    print("Loading embedding model (discogs-effnet)...")
-    embedding_model = TensorflowPredictEffnetDiscogs(
-        graphFilename=EMBEDDING_MODEL_FILE,
-        output="PartitionedCall:1"
-    )
+    print(f"Scanning {MUSIC_FOLDER}...")
+    manifest = Manifest(MANIFEST_FILE, config_fingerprint())
+    # A shard node writes nothing shared, its results go to the shard file; a dry run writes nothing at all
+    stores = ()
+    if not args.shard and not args.dry_run:
+        scores = MatrixStore(SCORES_DIR, len(classes), np.float32, columns=classes)
+        embeddings = MatrixStore(EMBEDDINGS_DIR, EMBEDDING_DIM, np.float16)
+        stores = (scores, embeddings)
+        # A file the manifest records as done must also have its stored rows
+        manifest.before_commit = lambda: flush_stores(stores)
+    progress = Progress("Progress", PROGRESS_INTERVAL)
+    changes = {"new": 0, "changed": 0, "reconfigured": 0, "unchanged": 0}
 
-    print("Loading classifier model (mtg-jamendo-moodtheme)...")
-    classifier_model = TensorflowPredict2D(graphFilename=CLASSIFIER_MODEL_FILE)
+    # Dry runs change nothing, so they neither resume nor leave anything to resume.
+    # A shard node resumes from its results file
+    analysing = args.apply_shards is None
+    journal = shard_output = None
+    if args.shard:
+        output_file = args.shard_output or shard_file(SHARDS_DIR, *args.shard)
+        shard_output, done = open_shard_output(output_file, manifest.config_version, classes, *args.shard,
+                                               resume=args.resume, sync_every=JOURNAL_SYNC_EVERY)
+        completed = {os.path.join(MUSIC_FOLDER, path): entry for path, entry in done.items()}
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: results go to {output_file}")
+    elif not args.dry_run:
+        journal = Journal(JOURNAL_FILE, manifest.config_version, JOURNAL_SYNC_EVERY)
+    if journal is not None:
+        completed = journal.open(args.resume)
+    elif shard_output is None:
+        completed = {}
+    if journal is not None and stores:
+        # A synced journal entry must also find its stored rows after a crash
+        journal.before_sync = lambda: flush_stores(stores)
+    resumed = {"files": 0}  # Journaled files skipped by walk()
+    if args.resume and not completed:
+        print("No interrupted run to resume, starting from the beginning.")
 
-    print(f"Scanning {MUSIC_FOLDER}...")
-    file_count = 0
-    tagged_count = 0
-
-    for root, dirs, files in os.walk(MUSIC_FOLDER):
-        for file in files:
-            if file.lower().endswith(('.mp3', '.flac', '.m4a', '.mp4')):
-                file_count += 1
-                full_path = os.path.join(root, file)
-                tags = get_ai_tags(full_path, embedding_model, classifier_model, classes)
-                if tags:
-                    tagged_count += 1
-                    append_tags_to_file(full_path, tags)
-
-    print(f"Done! Processed {file_count} files, tagged {tagged_count}.")
+    def report_resumed():
+        if completed:
+            print(f"Resuming: {resumed['files']} files were finished before the interruption.")
+
+    _startup["state"] = time.perf_counter() - run_started
+
+    def walk():
+        # Files that are new, modified, or tagged under another config (every file with --full)
+        manifest.begin_scan()
+        for path in iter_audio_files(MUSIC_FOLDER, args.extensions, args.include, args.exclude):
+            if args.shard and shard_of(path, MUSIC_FOLDER, args.shard[1]) != args.shard[0]: continue
+            status = manifest.classify(path)
+            changes[status] += 1
+            if (path in completed and succeeded(completed[path]["status"], completed[path].get("write"))
+                    and (not stores or path in scores.rows)):
+                # Its manifest entry may not have been committed before the interruption (its stored
+                # rows neither: those without them are analysed again)
+                if shard_output is None: manifest.record(path)
+                resumed["files"] += 1
+                continue
+            if args.full or status != "unchanged":
+                yield path, status
+
+    def discover():
+        # Stream files into the processing stages while the library is still being walked
+        for path, _ in walk():
+            progress.add()
+            yield path
+        progress.finish_discovery()
+
+    cost_model = CostModel(COST_MODEL_FILE) if budget is not None else None
+    scheduled = {"candidates": 0, "sizes": {}, "samples": []}
+
+    def schedule():
+        # Walk the whole library first, then take files by priority while the budget lasts
+        candidates = []
+        for path, status in walk():
+            try: st = os.stat(path)
+            except OSError: continue
+            candidates.append((path, status, st.st_size, st.st_mtime))
+        costs = {path: cost_model.estimate(path, size) for path, _, size, _ in candidates}
+        planned, estimate = plan(candidates, costs, budget.remaining(), args.max_files)
+        scheduled["candidates"] = len(candidates)
+        by_status = ", ".join(f"{sum(c[1] == status for c in planned)} {status}" for status in PRIORITIES
+                              if any(c[1] == status for c in planned))
+        print(f"Scheduled {len(planned)} of {len(candidates)} files (estimated {format_duration(estimate)}): {by_status or 'none'}")
+        progress.add(len(planned))
+        progress.finish_discovery()
+        for path, _, size, _ in planned:
+            if not budget.admit(path, costs[path]):
+                print("Time budget reached, no new files are started.")
+                break
+            scheduled["sizes"][path] = size
+            yield path
+
+    merged = {"stale": 0}
+
+    def shard_results():
+        # Results of the --shard runs in place of analysis; files modified since are left for a normal run
+        try: headers, entries = read_shards(args.apply_shards or [SHARDS_DIR])
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            exit(1)
+        for count, missing in missing_shards(headers).items():
+            print(f"{count} shards: {count - len(missing)} results files found"
+                  f"{', missing shards ' + ', '.join(map(str, missing)) if missing else ''}")
+        rules = get_tag_rules(classes)
+        for relative, (header, entry) in entries.items():
+            if header["classes"] != classes: continue  # Reported below, once per file
+            path = os.path.join(MUSIC_FOLDER, relative)
+            if path in completed and succeeded(completed[path]["status"], completed[path].get("write")):
+                resumed["files"] += 1
+                continue
+            # Already applied (writing the tags changed the file), unless --full
+            if not args.full and manifest.status(path) == "unchanged": continue
+            if not unchanged_since_analysis(path, entry):
+                merged["stale"] += 1
+                continue
+            result = shard_result(path, entry)
+            if header["config"] != manifest.config_version and result["status"] in ("tagged", "untagged"):
+                # Analysed under other thresholds: decide again from the stored predictions
+                result["tags"], result["debug"] = rules.decide(result["predictions"])[0]
+                result["status"] = "tagged" if result["tags"] else "untagged"
+                decided = result.pop("heads", {})
+                result["heads"] = {}
+                for head in heads:
+                    scores = decided.get(head.name, {}).get("predictions")
+                    if scores is None or len(scores) != len(head.classes): continue  # Head added or changed since
+                    tags, debug = head.decide(scores)[0]
+                    result["heads"][head.name] = {"tags": tags, "debug": debug, "predictions": scores}
+            progress.add()
+            yield result
+        for header in headers:
+            if header["classes"] != classes:
+                print(f"Warning: {header['file']} was analysed with other models, its results were skipped.")
+        progress.finish_discovery()
+
+    if not analysing:
+        pending = shard_results()
+    else:
+        pending = schedule() if budget is not None else discover()
+    with stage(_startup, "first file"):
+        first = next(pending, None)
+    if first is None and not args.watch:
+        if analysing:
+            finish_scan(manifest, stores, changes, forget_deleted=shard_output is None and not args.dry_run)
+        report_resumed()
+        manifest.close()
+        close_stores(stores)
+        if journal is not None:
+            journal.close(finished=not scheduled["candidates"])
+        if shard_output is not None:
+            shard_output.close()
+        if merged["stale"]:
+            print(f"Done! {merged['stale']} files changed since their shard analysed them, the next run picks them up.")
+        elif scheduled["candidates"]:
+            print(f"Done! No file fits in the time budget, {scheduled['candidates']} left for the next run.")
+        else:
+            print("Done! Nothing to do, all files are up to date.")
+        print_startup()
+        return
+    pending = itertools.chain([first], pending) if first is not None else iter(())
+
+    # The cache and duplicate index are shared state: shard nodes and dry runs leave them alone like the stores
+    writable = analysing and not args.shard and not args.dry_run
+    cache = None
+    if CACHE_ENABLED and writable:
+        cache = PredictionCache(CACHE_FILE, [EMBEDDING_MODEL_FILE, CLASSIFIER_MODEL_FILE, META_FILE], max_mb=CACHE_MAX_MB)
+        if cache.invalidated:
+            print("Models changed since last run, prediction cache cleared.")
+    duplicates = None
+    if DUPLICATES_ENABLED and writable:
+        duplicates = open_duplicates(args.adaptive)
+        if duplicates.invalidated:
+            print("Models or analysis settings changed since last run, duplicates index cleared.")
+
+    if args.decoder == "av" and importlib.util.find_spec("av") is None:
+        print("Warning: PyAV is not installed, decoding with ffmpeg instead.")
+    print("Processing files..." if analysing else "Applying shard results...")
+    counts = {"files": 0, "tagged": 0, "cache_hits": 0, "duplicates": 0, "windows": {}, "verified": 0, "agreed": 0,
+              "saved": 0, "unchanged": 0, "planned": 0, "error": 0, "rewrites": 0, "bytes": 0}
+    embedded = set()  # Paths whose embedding was stored since the projection was last updated
+    metrics = Metrics(args.metrics) if args.metrics else None
+    options = {
+        "cache": cache is not None, "decoder": args.decoder, "batch_size": args.batch_size,
+        # Budgeted runs time every file to refine the cost model
+        "adaptive": args.adaptive, "adaptive_verify": args.adaptive_verify, "metrics": metrics is not None or budget is not None,
+        "decoder_threads": args.decoder_threads, "duplicates": duplicates is not None,
+    }
+
+    def write(result):
+        timings = result.setdefault("timings", {}) if options["metrics"] else None
+        outcome = {"action": None}
+        counts["files"] += 1
+        if result["cached"]:
+            counts["cache_hits"] += 1
+        if "duplicate_of" in result:
+            counts["duplicates"] += 1
+        if "window" in result:
+            counts["windows"][result["window"]] = counts["windows"].get(result["window"], 0) + 1
+        if "full_tags" in result:
+            counts["verified"] += 1
+            counts["agreed"] += sorted(result["full_tags"]) == sorted(result["tags"])
+        report_result(result)
+        progress.advance()
+        if result["tags"]:
+            counts["tagged"] += 1
+        fields = head_fields(result, heads)
+        if (result["tags"] or fields) and shard_output is None:
+            with stage(timings, "save"):
+                outcome = append_tags_to_file(result["path"], result["tags"], args.dry_run, fields)
+            counts[outcome["action"]] += 1
+            if outcome["bytes"]:
+                counts["rewrites"] += 1
+                counts["bytes"] += outcome["bytes"]
+            if metrics is not None:
+                metrics.count(f"write_{outcome['action']}")
+        if metrics is not None:
+            metrics.count(result["status"])
+            if result["cached"]: metrics.count("cache_hit")
+            if "duplicate_of" in result: metrics.count("duplicate")
+            if result["debug"] and result["debug"][0].endswith("*"): metrics.count("fallback_tagged")
+            metrics.record(result["path"], result["status"], timings)
+        if "predictions" in result and stores:
+            # Before the manifest records the file: its commits flush the stores first
+            scores.put(result["path"], result["predictions"])
+            embeddings.put(result["path"], normalize(result["embedding"]))
+            embedded.add(result["path"])
+        if not args.dry_run and shard_output is None and succeeded(result["status"], outcome["action"]):
+            manifest.record(result["path"])
+        if journal is not None:
+            journal.record(result["path"], result["status"], result["tags"], outcome["action"])
+        if shard_output is not None:
+            shard_output.record(relative_path(result["path"], MUSIC_FOLDER), result["status"], result["tags"],
+                                **shard_entry(result))
+        if budget is not None:
+            budget.finish(result["path"])
+            scheduled["samples"].append((result["path"], scheduled["sizes"].get(result["path"], 0),
+                                         sum(timings.values()), time.monotonic()))
+
+    pool = None
+    threads = configure_threads(args.workers, args.tf_intra_threads, args.tf_inter_threads)
+    if not analysing:
+        pass
+    elif args.workers > 1:
+        # Workers open their own cache connections; the parent only writes tags
+        # (its duplicates index connection only forgets deleted files)
+        if cache is not None:
+            cache.close()
+            cache = None
+        print(f"Starting {args.workers} workers ({threads} TensorFlow threads each)...")
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(args.workers, initializer=init_worker, initargs=(classes, options))
+    else:
+        decode, analyze = make_analyzer(classes, cache, options, duplicates)
+
+    def process(paths):
+        # Run files through the models loaded above; also used by the watch loop
+        if pool is not None:
+            # A few chunks in flight per worker: imap would have its feeder thread drain paths at once
+            # (and a budgeted run admit every planned file before any of them is analysed)
+            chunks = chunked(paths, args.batch_size)
+            in_flight = collections.deque(pool.apply_async(analyze_in_worker, (chunk,))
+                                          for chunk in itertools.islice(chunks, args.workers * 2))
+            while in_flight:
+                results = in_flight.popleft().get()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    in_flight.append(pool.apply_async(analyze_in_worker, (chunk,)))
+                for result in results:
+                    write(result)
+        elif args.decode_workers > 0:
+            run_pipeline(paths, decode, analyze, write, decode_workers=args.decode_workers,
+                         decode_queue_size=max(args.decode_queue, args.batch_size), write_queue_size=args.write_queue,
+                         batch_size=args.batch_size, batch_wait=args.batch_wait)
+        else:
+            for chunk in chunked(paths, args.batch_size):
+                for result in analyze([(path, decode(path)) for path in chunk]):
+                    write(result)
+
+    def refresh_similarity():
+        # Projection used by similar.py for fast queries on large libraries
+        flush_stores(stores)
+        if embedded:
+            build_projection(EMBEDDINGS_DIR, embedded)
+            embedded.clear()
+
+    if analysing:
+        process(pending)
+        # A shard only saw its own files; the others are not deleted
+        finish_scan(manifest, stores, changes, duplicates, forget_deleted=shard_output is None and not args.dry_run)
+    else:
+        for result in pending:
+            write(result)
+    report_resumed()
+    refresh_similarity()
+    left = scheduled["candidates"] - counts["files"]
+    if journal is not None:
+        # Files left by the budget are picked up by the next run (with --full, it needs --resume)
+        journal.close(finished=left <= 0)
+        journal = None  # The watch loop relies on the manifest alone
+    if shard_output is not None:
+        shard_output.close()
+    print(f"Done! Processed {counts['files']} files, tagged {counts['tagged']}.")
+    if budget is not None:
+        elapsed = time.perf_counter() - run_started
+        print(f"Budget: {format_duration(elapsed)} used, {max(0, left)} files left for the next run"
+              f"{' (run it with --resume)' if left > 0 and args.full else ''}.")
+        if not args.dry_run:
+            cost_model.update(scheduled["samples"])
+            cost_model.save()
+    if shard_output is not None:
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: results of {counts['files']} files in {shard_output.path}, "
+              f"write their tags with --apply-shards once every shard is done.")
+    elif args.dry_run:
+        print(f"Dry run: {counts['planned']} files would be updated, {counts['unchanged']} already up to date.")
+    else:
+        print(f"Tag writes: {counts['saved'] - counts['rewrites']} in place, {counts['rewrites']} full rewrites "
+              f"({counts['bytes']/1e6:.1f} MB rewritten), {counts['unchanged']} unchanged files skipped, {counts['error']} errors.")
+    if merged["stale"]:
+        print(f"Shard results: {merged['stale']} files changed since their shard analysed them, the next run picks them up.")
+    if cache is not None:
+        print(f"Prediction cache: {counts['cache_hits']} of {counts['files']} files served from cache.")
+    if duplicates is not None:
+        print(f"Duplicates: {counts['duplicates']} files reused the predictions of the same recording elsewhere, "
+              f"{len(duplicates.clusters())} recordings found in several files (comprehensive_analysis.py --duplicates lists them).")
+    if args.adaptive:
+        stages = ", ".join(f"{window}s: {counts['windows'].get(window, 0)}" for window in ADAPTIVE_WINDOWS)
+        print(f"Adaptive window: {stages} files")
+        if counts["verified"]:
+            print(f"Agreement with full {CHUNK_DURATION}s analysis: {counts['agreed']}/{counts['verified']} "
+                  f"({counts['agreed']/counts['verified']*100:.1f}%)")
+    print_startup()
+    if args.watch:
+        def process_arrivals(paths):
+            progress.add(len(paths))
+            process(paths)
+            refresh_similarity()
+        watch_library(args, manifest, stores, process_arrivals, duplicates)
+    manifest.close()
+    close_stores(stores)
+    if pool is not None:
+        pool.terminate()
+
+    if metrics is not None:
+        summary = metrics.close()
+        print(f"Stage timings ({summary['files']} files, {summary['files_per_s']:.2f} files/s):")
+        for name, timing in summary["stages"].items():
+            print(f"   {name}: p50 {timing['p50_ms']:.0f} ms | p90 {timing['p90_ms']:.0f} ms | "
+                  f"p99 {timing['p99_ms']:.0f} ms | total {timing['total_s']:.1f}s")
+        print(f"Metrics written to {args.metrics}")
+    if cache is not None:
+        cache.close()
+    if duplicates is not None:
+        duplicates.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Change notification for the watch daemon: inotify through libc (Linux), with
+# a polling fallback for systems and mounts where inotify is not available.
+# Events only nominate paths; whether a file needs tagging is decided against
+# the manifest, so the daemon's own tag writes do not trigger a second pass.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")  # struct inotify_event: wd, mask, cookie, len
+
+class InotifyWatcher:
+    """Paths created, written, moved or deleted under root, one watch per directory"""
+
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}  # Watch descriptor -> directory
+        try: self.watch_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch_tree(self, root):
+        """Watch root and every directory below it; returns the files already in them"""
+        files = []
+        for directory, _, names in os.walk(root):
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT: continue  # Removed while walking
+                raise OSError(error, f"Cannot watch {directory} (fs.inotify.max_user_watches too low?)")
+            self.directories[wd] = directory
+            files.extend(os.path.join(directory, name) for name in names)
+        return files
+
+    def poll(self, timeout):
+        """(changed paths, rescan needed), waiting at most timeout seconds for events"""
+        if not select.select([self.fd], [], [], timeout)[0]: return set(), False
+        try: data = os.read(self.fd, 65536)
+        except BlockingIOError: return set(), False
+
+        paths, rescan = set(), False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                rescan = True  # Events were dropped by the kernel
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name: continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # Files can land in a new folder before its watch exists, so report them too
+                if mask & (IN_CREATE | IN_MOVED_TO): paths.update(self.watch_tree(path))
+                # A folder moved away takes its files along without an event per file
+                if mask & IN_MOVED_FROM: rescan = True
+                continue
+            paths.add(path)
+        return paths, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """No events: asks for a rescan of the library every interval seconds"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_scan = time.monotonic() + interval
+
+    def poll(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set(), False
+        time.sleep(max(0, wait))
+        self.next_scan = time.monotonic() + self.interval
+        return set(), True
+
+    def close(self):
+        pass
+
+def open_watcher(root, poll_interval, polling=False):
+    """inotify when available, otherwise polling; returns (watcher, description)"""
+    if not polling:
+        try: return InotifyWatcher(root), "inotify"
+        except (OSError, AttributeError) as e:  # AttributeError: no inotify in this libc
+            print(f"inotify unavailable ({e}), falling back to polling.")
+    return PollingWatcher(poll_interval), f"polling every {poll_interval}s"
+
+def file_signature(path):
+    try: st = os.stat(path)
+    except OSError: return None
+    return st.st_size, st.st_mtime_ns
+
+class Debouncer:
+    """Files become ready once no event arrived for delay seconds and their size and mtime held still"""
+
+    def __init__(self, delay, max_pending):
+        self.delay = delay
+        self.max_pending = max_pending
+        self.pending = {}  # Path -> (time of the last event, signature at that time)
+        self.overflowed = False
+
+    def add(self, paths):
+        now = time.monotonic()
+        for path in paths:
+            if path not in self.pending and len(self.pending) >= self.max_pending:
+                # Bounded memory: the caller rescans the library for the dropped files later
+                self.overflowed = True
+                continue
+            self.pending[path] = (now, file_signature(path))
+
+    def ready(self):
+        now = time.monotonic()
+        ready = []
+        for path, (seen, signature) in list(self.pending.items()):
+            if now - seen < self.delay: continue
+            current = file_signature(path)
+            if current != signature:
+                self.pending[path] = (now, current)  # Still being copied
+                continue
+            del self.pending[path]
+            ready.append(path)
+        return ready